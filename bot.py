@@ -5,34 +5,147 @@
 
 '''
 
+import argparse
 import asyncio
+import bisect
+import collections
 import datetime
+import functools
+import gzip
+import heapq
 import json
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
 import random
 import re
+import sqlite3
+import time
+import weakref
 
 import discord
 from discord.ext import commands
+from sortedcontainers import SortedList
 
 logging.basicConfig(
     level=logging.INFO,
     format=' %(asctime)s - %(levelname)s - %(message)s')
 
+class JSONFormatter(logging.Formatter):
+    ''' Format log records as compact JSON objects
+'''
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname}
+        if hasattr(record, "event"):
+            entry["event"] = record.event
+            entry.update(record.fields)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    ''' Keep a fraction of the log records of each event type
+        Moderation events and records without an event are always kept
+'''
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates, moderation=1)
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None), 1)
+        return rate >= 1 or random.random() < rate
+
+def configure_logging(settings):
+    ''' Log through a queue which is written by a background thread
+        Return the listener which writes the queued records
+'''
+    handler = logging.StreamHandler()
+    if settings["structured"]:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            ' %(asctime)s - %(levelname)s - %(message)s'))
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(settings["sampling"]))
+    logging.getLogger().handlers = [queue_handler]
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
+
+def log_event(event, **fields):
+    ''' Log an event with the IDs of the objects involved
+'''
+    logging.info(
+        "%s: %s", event, fields, extra={"event": event, "fields": fields})
+
+def timed(name):
+    ''' Record the run time of a coroutine method in the bot metrics
+        The method is called directly when metrics are not active
+'''
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            metrics = getattr(self, 'bot', self).metrics
+            if not metrics.active:
+                return await function(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await function(self, *args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter()-start)
+        return wrapper
+    return decorator
+
 class Utils(commands.Bot):
     '''
 '''
-    def __init__(self, *, prefix, name):
+    def __init__(self, *, prefix, name,
+                 database=os.path.join('data', 'utils.db'), recording=None,
+                 process=0, **options):
         self.name = name
+        with open(os.path.join('data', 'utils.txt')) as file:
+            self.data = json.load(file)
+        #Compiled cog data files which are reloaded when they change
+        self.config = ConfigStore(
+            capacity=self.data["guilds"]["capacity"], **self.data["config"])
+        #Queue guild events to be handled outside of the gateway loop
+        self.dispatcher = EventDispatcher(self, **self.data["dispatch"])
+        self.log_listener = configure_logging(self.data["logging"])
         #Manage intents to allow bot to view all members
         intents = discord.Intents.default()
         intents.members = True
         intents.guilds = True
-        commands.Bot.__init__(
-            self, command_prefix=prefix, intents=intents,
-            self_bot=False)
+        #Cogs work from raw events, so no messages are cached by default
+        options.setdefault("max_messages", None)
+        super().__init__(
+            command_prefix=prefix, intents=intents,
+            self_bot=False, **options)
+        #Record the raw gateway events to replay them offline
+        self.recorder = None
+        if recording is not None:
+            self.recorder = EventRecorder(recording)
+            self.add_listener(self.recorder.record, "on_socket_response")
+        #Open database for state which persists between restarts
+        #Processes running other shards may share the database
+        self.database = sqlite3.connect(database, timeout=30)
+        self.database.execute("PRAGMA journal_mode=WAL")
+        self.role_index = RoleIndex()
+        self.resolver = Resolver(**self.data["resolver"])
+        self.actions = ActionScheduler()
+        self.panels = PanelRegistry(self.database, self.owns)
+        self.timers = TimerScheduler(self)
+        self.notifier = Notifier(**self.data["notifications"])
+        #Each process serves its metrics on its own port
+        self.metrics = Metrics(self, **{
+            **self.data["metrics"],
+            "port": self.data["metrics"]["port"]+process})
         #Call feature classes
+        self.add_cog(self.metrics)
         self.add_cog(GhostPing(self))
         self.add_cog(GuildPoints(self))
         self.add_cog(Moderation(self))
@@ -40,27 +153,147 @@ class Utils(commands.Bot):
         self.add_cog(VoiceChannelControl(self))
         self.add_cog(WelcomeMessage(self))
 
+    def dispatch(self, event_name, *args, **kwargs):
+        ''' Queue guild events by guild and channel
+            All other events are dispatched immediately
+'''
+        key = self.dispatcher.route(event_name, args)
+        if key is None:
+            super().dispatch(event_name, *args, **kwargs)
+        else:
+            self.resolve_waiters(event_name, args)
+            self.dispatcher.submit(key, event_name, args, kwargs)
+
+    def resolve_waiters(self, event_name, args):
+        ''' Resolve the wait_for futures of a queued event
+            Queued events do not pass through Client.dispatch, which
+            resolves them for all other events
+'''
+        listeners = self._listeners.get(event_name)
+        if not listeners:
+            return
+        remaining = []
+        for future, condition in listeners:
+            if future.cancelled():
+                continue
+            try:
+                result = condition(*args)
+            except Exception as error:
+                future.set_exception(error)
+                continue
+            if not result:
+                remaining.append((future, condition))
+            elif len(args) == 1:
+                future.set_result(args[0])
+            else:
+                future.set_result(args or None)
+        if remaining:
+            listeners[:] = remaining
+        else:
+            del self._listeners[event_name]
+
     async def on_ready(self):
         '''
 '''
         logging.info("Ready: %s", self.name)
+        for guild in self.guilds:
+            self.role_index.build(guild)
+        self.timers.start()
+        self.config.start()
+        await self.metrics.start()
+
+    async def on_guild_join(self, guild):
+        '''
+'''
+        self.role_index.build(guild)
+
+    async def close(self):
+        ''' Write cached state to the database before closing the bot
+'''
+        guild_points = self.get_cog("GuildPoints")
+        if guild_points is not None:
+            guild_points.ledger.flush()
+        await super().close()
+        self.database.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.log_listener.stop()
+
+    def owns(self, guild_id):
+        ''' Check if a guild is handled by the shards of this process
+'''
+        shard_ids = getattr(self, 'shard_ids', None)
+        if shard_ids is None or guild_id is None:
+            return True
+        return (guild_id >> 22) % self.shard_count in shard_ids
 
     async def on_member_join(self, member):
         '''
 '''
-        logging.info("Member Join: %s", member)
+        log_event("member_join", guild=member.guild.id, member=member.id)
+        self.role_index.add(member, member.roles)
+
+    async def on_member_remove(self, member):
+        '''
+'''
+        self.role_index.remove(member, member.roles)
+        self.resolver.invalidate("member", member.id)
+
+    async def on_member_update(self, before, after):
+        '''
+'''
+        if before.roles != after.roles:
+            self.role_index.update(before, after)
+
+    async def on_user_update(self, before, after):
+        '''
+'''
+        if before.name != after.name:
+            self.resolver.invalidate("member", after.id)
+
+    async def on_guild_role_update(self, before, after):
+        '''
+'''
+        if before.name != after.name:
+            self.resolver.invalidate("role", after.id)
+
+    async def on_guild_role_delete(self, role):
+        '''
+'''
+        self.role_index.discard(role)
+        self.resolver.invalidate("role", role.id)
+
+    async def on_guild_channel_update(self, before, after):
+        '''
+'''
+        if before.name != after.name:
+            self.resolver.invalidate("channel", after.id)
+
+    async def on_guild_channel_delete(self, channel):
+        '''
+'''
+        self.resolver.invalidate("channel", channel.id)
+
+    async def on_raw_message_delete(self, payload):
+        '''
+'''
+        self.panels.remove(payload.message_id)
 
     async def on_message(self, message):
         '''
 '''
-        logging.info("Message: %s", message)
         if message.author.bot:
             return
+        log_event(
+            "message", guild=getattr(message.guild, 'id', None),
+            channel=message.channel.id, message=message.id,
+            author=message.author.id)
         if await self.check_message(message):
             await message.delete()
             return
         await self.process_commands(message)
 
+    @timed("check_message")
     async def check_message(self, message):
         ''' Run message through spam and censor moderation functions
             Determine if message should be flagged
@@ -68,9 +301,11 @@ class Utils(commands.Bot):
         moderation = self.get_cog("Moderation")
         flags = []
         if moderation is not None:
-            if moderation.data["actives"]["spam"]:
+            actives = moderation.guild_data(
+                getattr(message.guild, 'id', None))["actives"]
+            if actives["spam"]:
                 flags.append(await moderation.spam(message))
-            if moderation.data["actives"]["commands"]:
+            if actives["censor"]:
                 flags.append(await moderation.censor(message))
             return any(flags)
         return False
@@ -79,85 +314,1461 @@ class Utils(commands.Bot):
         ''' Run command through command moderation function
             Determine if message should be flagged
 '''
-        moderation = self.get_cog("Moderation")
-        if moderation is not None:
-            if moderation.data["actives"]["commands"]:
-                return await moderation.commands(ctx)
-        return False
+        moderation = self.get_cog("Moderation")
+        #Commands in direct messages have no guild settings to check
+        if moderation is not None and ctx.guild is not None:
+            data = moderation.guild_data(ctx.guild.id)
+            if data["actives"]["commands"]:
+                return await moderation.commands(ctx)
+        return False
+
+class ShardedUtils(Utils, commands.AutoShardedBot):
+    ''' Run the bot with one or more shards in a single process
+        Cog state is keyed by guild, so each guild lives in one process
+'''
+
+class EventDispatcher:
+    ''' Handle guild events in per-channel queues
+        Events in a channel are handled in the order they were received
+        Each guild handles a limited number of channels at the same time
+        Events are dropped once a channel queue is full
+'''
+    message_events = {"message", "message_delete"}
+    payload_events = {
+        "raw_message_delete", "raw_bulk_message_delete",
+        "raw_reaction_add", "raw_reaction_remove"}
+    member_events = {
+        "member_join", "member_remove", "member_update",
+        "voice_state_update"}
+
+    def __init__(self, bot, *, concurrency, queue_size):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queues = {}
+        self.workers = {}
+        self.semaphores = {}
+        self.active = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def route(self, event_name, args):
+        ''' Get the guild and channel key of the queue for an event
+            Return None if the event is not queued
+'''
+        if event_name in self.message_events:
+            message = args[0]
+            guild_id = message.guild.id if message.guild is not None else None
+            return (guild_id, message.channel.id)
+        if event_name in self.payload_events:
+            return (args[0].guild_id, args[0].channel_id)
+        if event_name in self.member_events:
+            return (args[0].guild.id, None)
+        return None
+
+    def submit(self, key, event_name, args, kwargs):
+        ''' Add an event to the queue of a guild channel
+'''
+        events = self.queues.setdefault(key, collections.deque())
+        if len(events) >= self.queue_size:
+            self.dropped[key[0]] += 1
+            logging.warning("Event Dropped: %s %s", event_name, key)
+            return
+        events.append((event_name, args, kwargs))
+        if key not in self.workers:
+            if not self.active[key[0]]:
+                self.semaphores[key[0]] = asyncio.Semaphore(self.concurrency)
+            self.active[key[0]] += 1
+            self.workers[key] = asyncio.ensure_future(self.work(key))
+
+    async def work(self, key):
+        ''' Handle the events in a queue until it is empty
+'''
+        events = self.queues[key]
+        semaphore = self.semaphores[key[0]]
+        try:
+            while events:
+                async with semaphore:
+                    await self.handle(*events.popleft())
+        finally:
+            del self.workers[key]
+            del self.queues[key]
+            self.active[key[0]] -= 1
+            if not self.active[key[0]]:
+                del self.active[key[0]]
+                del self.semaphores[key[0]]
+
+    async def handle(self, event_name, args, kwargs):
+        ''' Run the bot and cog listeners for an event
+'''
+        method = 'on_' + event_name
+        listeners = self.bot.extra_events.get(method, [])
+        if hasattr(self.bot, method):
+            listeners = [getattr(self.bot, method)] + listeners
+        metrics = self.bot.metrics
+        for listener in listeners:
+            start = time.perf_counter()
+            try:
+                await listener(*args, **kwargs)
+            except Exception:
+                await self.bot.on_error(method, *args, **kwargs)
+            if metrics.active:
+                metrics.observe(
+                    f"listener:{listener.__qualname__}",
+                    time.perf_counter()-start)
+
+    def depths(self):
+        ''' Get the number of queued events for each guild
+'''
+        depths = collections.Counter()
+        for (guild_id, _), events in self.queues.items():
+            depths[guild_id] += len(events)
+        return depths
+
+class EventRecorder:
+    ''' Write raw gateway dispatches to a gzipped JSON lines file
+        Each line has the seconds since the recording started
+'''
+    events = {
+        "READY", "GUILD_CREATE", "GUILD_MEMBER_ADD", "GUILD_MEMBER_REMOVE",
+        "GUILD_MEMBER_UPDATE", "MESSAGE_CREATE", "MESSAGE_DELETE",
+        "MESSAGE_DELETE_BULK", "MESSAGE_REACTION_ADD",
+        "MESSAGE_REACTION_REMOVE", "VOICE_STATE_UPDATE"}
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'at', encoding='utf-8')
+        self.start = time.monotonic()
+
+    async def record(self, msg):
+        ''' Write a gateway message if it is a recorded dispatch
+'''
+        if not isinstance(msg, dict) or msg.get("op") != 0:
+            return
+        if msg.get("t") not in self.events:
+            return
+        self.file.write(json.dumps({
+            "time": round(time.monotonic()-self.start, 6),
+            "t": msg["t"], "d": msg["d"]}, separators=(',', ':'))+'\n')
+
+    def close(self):
+        self.file.close()
+
+class GuildCache:
+    ''' Keep the state of the most recently used guilds in memory
+        State is loaded on first use and the least recently used is evicted
+'''
+    def __init__(self, load, *, capacity=1000, evict=None):
+        self.load = load
+        self.capacity = capacity
+        self.evict = evict
+        self.guilds = collections.OrderedDict()
+
+    def __contains__(self, guild_id):
+        return guild_id in self.guilds
+
+    def __getitem__(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is not None:
+            self.guilds.move_to_end(guild_id)
+            return state
+        state = self.guilds[guild_id] = self.load(guild_id)
+        while len(self.guilds) > self.capacity:
+            old_id, old_state = self.guilds.popitem(last=False)
+            if self.evict is not None:
+                self.evict(old_id, old_state)
+        return state
+
+    def peek(self, guild_id):
+        ''' Get the state of a guild if it is loaded without using it
+'''
+        return self.guilds.get(guild_id)
+
+    def items(self):
+        return self.guilds.items()
+
+class ConfigStore:
+    ''' Compile the cog data files into structures for fast lookups
+        Changed files are recompiled and swapped in without a restart
+        Guilds may override the top level keys of a file in their own file
+'''
+    def __init__(self, directory='data', *, interval=5, capacity=1000):
+        self.directory = directory
+        self.interval = interval
+        self.files = {}
+        self.values = {}
+        self.guilds = GuildCache(lambda guild_id: {}, capacity=capacity)
+        self.task = None
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def path(self, name, guild_id=None):
+        if guild_id is None:
+            return os.path.join(self.directory, f"{name}.txt")
+        return os.path.join(
+            self.directory, 'guilds', str(guild_id), f"{name}.txt")
+
+    def load(self, name, compiler=None, reload=None):
+        ''' Compile a data file and watch it for changes
+            The reload function is called with the old and new config
+'''
+        path = self.path(name)
+        self.files[name] = {
+            "compiler": compiler, "reload": reload,
+            "mtime": os.stat(path).st_mtime_ns}
+        self.files[name]["data"], self.values[name] = self.compile(name)
+        return self.values[name]
+
+    def compile(self, name, overrides=None):
+        ''' Read and compile a data file with the overrides of a guild
+            Return the data and the compiled config
+'''
+        file = self.files[name]
+        if overrides is None:
+            with open(self.path(name)) as data:
+                data = json.load(data)
+        else:
+            data = dict(file["data"], **overrides)
+        if file["compiler"] is None:
+            return data, data
+        return data, file["compiler"](data)
+
+    def guild(self, name, guild_id):
+        ''' Get the config of a file for a guild
+            Guilds without their own file share the global config
+'''
+        if guild_id is None:
+            return self.values[name]
+        configs = self.guilds[guild_id]
+        entry = configs.get(name)
+        if entry is None:
+            entry = configs[name] = self.compile_guild(name, guild_id)
+        return entry["config"]
+
+    def compile_guild(self, name, guild_id):
+        ''' Compile the file of a guild on top of the global file
+            Invalid files are logged and the global config is used
+'''
+        path = self.path(name, guild_id)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return {"mtime": None, "config": self.values[name]}
+        try:
+            with open(path) as file:
+                _, config = self.compile(name, json.load(file))
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            logging.error(
+                "Guild Config Failed: %s: %s: %s", guild_id, name, error)
+            config = self.values[name]
+        return {"mtime": mtime, "config": config}
+
+    def reload(self):
+        ''' Recompile the files which changed since they were loaded
+            Invalid files are logged and the previous config is kept
+            Guild configs are recompiled the next time they are used
+'''
+        changed = set()
+        for name, file in self.files.items():
+            try:
+                mtime = os.stat(self.path(name)).st_mtime_ns
+            except OSError:
+                continue
+            if mtime == file["mtime"]:
+                continue
+            file["mtime"] = mtime
+            try:
+                file["data"], config = self.compile(name)
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                logging.error("Config Reload Failed: %s: %s", name, error)
+                continue
+            old, self.values[name] = self.values[name], config
+            changed.add(name)
+            log_event("config_reload", name=name)
+            if file["reload"] is not None:
+                file["reload"](old, config)
+        for guild_id, configs in self.guilds.items():
+            for name, entry in list(configs.items()):
+                try:
+                    mtime = os.stat(self.path(name, guild_id)).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if name in changed or mtime != entry["mtime"]:
+                    del configs[name]
+
+    def start(self):
+        ''' Start watching the files if they are not already watched
+'''
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.watch())
+
+    async def watch(self):
+        ''' Periodically reload the changed files
+'''
+        while True:
+            await asyncio.sleep(self.interval)
+            self.reload()
+
+class RoleIndex:
+    ''' Index the members which have each role
+        The index is updated incrementally from member events
+'''
+    def __init__(self):
+        self.members = {}
+
+    def build(self, guild):
+        ''' Index the roles of all members in a guild
+'''
+        for role in guild.roles:
+            self.members[role.id] = set()
+        for member in guild.members:
+            self.add(member, member.roles)
+
+    def add(self, member, roles):
+        ''' Record that a member has the roles
+'''
+        for role in roles:
+            self.members.setdefault(role.id, set()).add(member.id)
+
+    def remove(self, member, roles):
+        ''' Record that a member does not have the roles
+'''
+        for role in roles:
+            self.members.get(role.id, set()).discard(member.id)
+
+    def update(self, before, after):
+        ''' Record the roles a member gained and lost
+'''
+        self.remove(after, set(before.roles)-set(after.roles))
+        self.add(after, set(after.roles)-set(before.roles))
+
+    def discard(self, role):
+        ''' Remove a deleted role from the index
+'''
+        self.members.pop(role.id, None)
+
+    def member_ids(self, role):
+        ''' Get the IDs of the members which have a role
+'''
+        return self.members.get(role.id, set())
+
+    def count(self, role):
+        ''' Get the number of members which have a role
+'''
+        return len(self.members.get(role.id, ()))
+
+    def is_orphaned(self, role):
+        ''' Check if no member has a role
+'''
+        return not self.members.get(role.id)
+
+class Resolver:
+    ''' Resolve members, roles and channels of a guild by ID
+        Lookups use the hash-based getters of the guild and the display
+        names of resolved objects are cached until they change
+'''
+    getters = {
+        "member": "get_member", "role": "get_role", "channel": "get_channel"}
+
+    def __init__(self, *, capacity=10000):
+        self.capacity = capacity
+        self.names = collections.OrderedDict()
+        self.named = {}
+
+    def get(self, guild, kind, object_id):
+        ''' Get a member, role or channel of a guild or None if it is gone
+'''
+        if guild is None or object_id is None:
+            return None
+        return getattr(guild, self.getters[kind])(int(object_id))
+
+    def member(self, guild, member_id):
+        return self.get(guild, "member", member_id)
+
+    def role(self, guild, role_id):
+        return self.get(guild, "role", role_id)
+
+    def channel(self, guild, channel_id):
+        return self.get(guild, "channel", channel_id)
+
+    def name(self, guild, kind, object_id):
+        ''' Get the display name of a member, role or channel
+            Deleted objects are named with their kind and ID
+'''
+        key = (kind, int(object_id))
+        if key in self.names:
+            self.names.move_to_end(key)
+            return self.names[key]
+        found = self.get(guild, kind, object_id)
+        if found is None:
+            return f"deleted {kind} ({object_id})"
+        self.names[key] = found.name
+        if len(self.names) > self.capacity:
+            self.names.popitem(last=False)
+        return found.name
+
+    def display(self, guild, kind, object_ids):
+        ''' Get the display names of members, roles or channels
+'''
+        return [self.name(guild, kind, i) for i in object_ids]
+
+    def find(self, guild, kind, name):
+        ''' Get a role or channel of a guild by name
+            The ID found for each name is remembered for later lookups
+'''
+        key = (guild.id, kind, name)
+        found = self.get(guild, kind, self.named.get(key))
+        if found is not None and found.name == name:
+            return found
+        self.named.pop(key, None)
+        found = discord.utils.get(
+            guild.roles if kind == "role" else guild.channels, name=name)
+        if found is not None:
+            self.named[key] = found.id
+        return found
+
+    def invalidate(self, kind, object_id):
+        ''' Forget the display name of a renamed or deleted object
+'''
+        self.names.pop((kind, object_id), None)
+
+class ActionScheduler:
+    ''' Queue outbound REST actions by route bucket
+        Actions in a bucket run in order and buckets run concurrently
+        Redundant actions which are still queued are coalesced
+        Member edits in a guild share a concurrency limit
+'''
+    def __init__(self, *, member_edits=10):
+        self.queues = {}
+        self.workers = {}
+        self.pending = {}
+        self.role_changes = {}
+        self.member_edits = member_edits
+        self.guild_limits = weakref.WeakValueDictionary()
+
+    def submit(self, bucket, function, *args, key=None, **kwargs):
+        ''' Queue a coroutine function to be run in a bucket
+            Actions with the same key as a queued action are dropped
+            Actions without a key are not coalesced with earlier actions
+            Return a future for the result of the action
+'''
+        pending = self.pending.setdefault(bucket, {})
+        if key is None:
+            pending.clear()
+        elif key in pending:
+            return pending[key]
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(self.log_failure)
+        if key is not None:
+            pending[key] = future
+        self.queues.setdefault(bucket, collections.deque()).append(
+            (key, function, args, kwargs, future))
+        if bucket not in self.workers:
+            self.workers[bucket] = asyncio.ensure_future(self.work(bucket))
+        return future
+
+    async def work(self, bucket):
+        ''' Run the queued actions of a bucket until it is empty
+'''
+        actions = self.queues[bucket]
+        try:
+            while actions:
+                key, function, args, kwargs, future = actions.popleft()
+                if self.pending[bucket].get(key) is future:
+                    del self.pending[bucket][key]
+                try:
+                    result = await function(*args, **kwargs)
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        finally:
+            del self.workers[bucket]
+            del self.queues[bucket]
+            del self.pending[bucket]
+
+    @staticmethod
+    def log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.warning("Action Failed: %r", future.exception())
+
+    def edit_roles(self, member, *, add=(), remove=()):
+        ''' Queue a change to the roles of a member
+            Queued changes to the same member are folded into one edit
+'''
+        key = (member.guild.id, member.id)
+        change = self.role_changes.get(key)
+        if change is None:
+            change = self.role_changes[key] = {
+                "add": set(), "remove": set(),
+                "future": self.submit(
+                    ("member", *key), self.apply_roles, member)}
+        for role in add:
+            change["remove"].discard(role)
+            change["add"].add(role)
+        for role in remove:
+            change["add"].discard(role)
+            change["remove"].add(role)
+        return change["future"]
+
+    def guild_limit(self, guild_id):
+        ''' Get the semaphore which limits the member edits of a guild
+'''
+        limit = self.guild_limits.get(guild_id)
+        if limit is None:
+            limit = asyncio.Semaphore(self.member_edits)
+            self.guild_limits[guild_id] = limit
+        return limit
+
+    async def apply_roles(self, member):
+        ''' Apply the folded role changes of a member with one edit
+            Changes queued while waiting for the guild limit are included
+'''
+        async with self.guild_limit(member.guild.id):
+            change = self.role_changes.pop((member.guild.id, member.id))
+            roles = set(member.roles[1:])
+            new_roles = (roles | change["add"]) - change["remove"]
+            if new_roles != roles:
+                await member.edit(roles=list(new_roles))
+
+    def edit_voices(self, members, *, mute):
+        ''' Queue a change to the server mute of members
+            Members which are already in the state are skipped
+            Return a future for when all the edits have finished
+'''
+        return asyncio.gather(return_exceptions=True, *[
+            self.submit(
+                ("member", m.guild.id, m.id), self.edit_voice, m, mute=mute)
+            for m in members if m.voice is not None and m.voice.mute != mute])
+
+    async def edit_voice(self, member, *, mute):
+        ''' Edit the voice of a member within the member edit limit of the
+            guild so edits to many members run concurrently
+'''
+        async with self.guild_limit(member.guild.id):
+            await member.edit(mute=mute)
+
+    def add_reactions(self, message, emojis):
+        ''' Queue reactions to be added to a message in order
+'''
+        return asyncio.gather(return_exceptions=True, *[
+            self.submit(
+                ("message", message.id), message.add_reaction, emoji,
+                key=("add_reaction", str(emoji)))
+            for emoji in emojis])
+
+    def remove_reaction(self, message, emoji, member):
+        ''' Queue the removal of a member's reaction from a message
+'''
+        return self.submit(
+            ("message", message.id), message.remove_reaction,
+            emoji, member, key=("remove_reaction", str(emoji), member.id))
+
+    def clear_reactions(self, message):
+        ''' Queue the removal of all reactions from a message
+'''
+        return self.submit(
+            ("message", message.id), message.clear_reactions)
+
+class Notifier:
+    ''' Send direct message notifications to members
+        Notifications to a member within a window are sent as one embed
+        Direct message channels are cached with least recently used eviction
+        Sends are paced by a token bucket and expire if deferred too long
+'''
+    def __init__(self, *, window, rate, burst, expire, capacity):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.expire = expire
+        self.capacity = capacity
+        self.channels = collections.OrderedDict()
+        self.pending = {}
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.dropped = 0
+
+    def notify(self, member, embed):
+        ''' Queue an embed to be sent to a member
+'''
+        pending = self.pending.get(member.id)
+        if pending is None:
+            pending = self.pending[member.id] = {
+                "member": member, "embeds": [], "since": time.monotonic()}
+            self.schedule(member.id, self.window)
+        pending["embeds"].append(embed)
+
+    def schedule(self, member_id, delay):
+        asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self.flush(member_id)))
+
+    def take(self):
+        ''' Take a token if one is available
+'''
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens+(now-self.updated)*self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def flush(self, member_id):
+        ''' Send the queued embeds of a member as one message
+            The message is deferred while the rate limit is reached
+'''
+        pending = self.pending.get(member_id)
+        if pending is None:
+            return
+        if not self.take():
+            if time.monotonic()-pending["since"] < self.expire:
+                self.schedule(member_id, self.window)
+                return
+            del self.pending[member_id]
+            self.dropped += len(pending["embeds"])
+            logging.warning("Notification Expired: %s", member_id)
+            return
+        del self.pending[member_id]
+        try:
+            channel = await self.channel(pending["member"])
+            if channel is not None:
+                await channel.send(embed=self.combine(pending["embeds"]))
+        except discord.Forbidden:
+            #Members who do not accept direct messages are not retried
+            #until they are evicted from the cache
+            self.cache(member_id, None)
+        except discord.HTTPException as error:
+            logging.warning("Notification Failed: %s", error)
+
+    async def channel(self, member):
+        ''' Get the direct message channel of a member
+'''
+        if member.id in self.channels:
+            self.channels.move_to_end(member.id)
+            return self.channels[member.id]
+        channel = await member.create_dm()
+        self.cache(member.id, channel)
+        return channel
+
+    def cache(self, member_id, channel):
+        self.channels[member_id] = channel
+        self.channels.move_to_end(member_id)
+        while len(self.channels) > self.capacity:
+            self.channels.popitem(last=False)
+
+    @staticmethod
+    def combine(embeds, *, limit=5000):
+        ''' Combine embeds into one embed with a field for each embed
+'''
+        if len(embeds) == 1:
+            return embeds[0]
+        embed = discord.Embed(
+            title=f"{len(embeds)} New Notifications",
+            color=embeds[-1].color)
+        size = len(embed.title)
+        for count, notification in enumerate(embeds):
+            value = '\n'.join([
+                f"{f.name}: {f.value}" for f in notification.fields])[:1024]
+            value = value or '---'
+            size += len(notification.title)+len(value)
+            if count == 25 or size > limit:
+                embed.set_footer(text=f"...and {len(embeds)-count} more")
+                break
+            embed.add_field(
+                name=notification.title, value=value, inline=False)
+        return embed
+
+class PanelRegistry:
+    ''' Record the panel messages which the bot sends
+        Panels are stored in the database so they survive restarts
+'''
+    def __init__(self, database, owns):
+        self.database = database
+        self.database.execute(
+            "CREATE TABLE IF NOT EXISTS panels (message INTEGER PRIMARY KEY, "
+            "guild INTEGER, channel INTEGER, cog TEXT, kind TEXT, "
+            "state TEXT)")
+        self.database.commit()
+        self.panels = {
+            message: {
+                "guild": guild, "channel": channel, "cog": cog,
+                "kind": kind, "state": json.loads(state)}
+            for message, guild, channel, cog, kind, state
+            in self.database.execute(
+                "SELECT message, guild, channel, cog, kind, state "
+                "FROM panels")
+            if owns(guild)}
+
+    def register(self, message, cog, kind, **state):
+        ''' Record a panel message sent by a cog
+'''
+        self.record(
+            message.id, message.guild.id, message.channel.id, cog, kind,
+            **state)
+
+    def record(self, message_id, guild_id, channel_id, cog, kind, **state):
+        ''' Record a panel by ID, such as a panel which was not found
+'''
+        self.panels[message_id] = {
+            "guild": guild_id, "channel": channel_id,
+            "cog": cog, "kind": kind, "state": state}
+        self.save(message_id)
+
+    def get(self, message_id, cog):
+        ''' Get a panel if it was sent by the cog
+'''
+        panel = self.panels.get(message_id)
+        if panel is None or panel["cog"] != cog:
+            return None
+        return panel
+
+    def find(self, cog, *, guild=None):
+        ''' Get the IDs and panels sent by a cog
+            Only the panels in the guild are returned if one is given
+'''
+        return [
+            (k, v) for k, v in self.panels.items() if v["cog"] == cog
+            and (guild is None or v["guild"] == guild)]
+
+    def update(self, message_id, kind, **state):
+        ''' Change the kind and state of a panel
+'''
+        panel = self.panels[message_id]
+        panel["kind"] = kind
+        panel["state"].update(state)
+        self.save(message_id)
+
+    def remove(self, message_id):
+        ''' Forget a panel
+'''
+        if self.panels.pop(message_id, None) is None:
+            return
+        self.database.execute(
+            "DELETE FROM panels WHERE message = ?", (message_id,))
+        self.database.commit()
+
+    def save(self, message_id):
+        panel = self.panels[message_id]
+        self.database.execute(
+            "INSERT OR REPLACE INTO panels VALUES (?, ?, ?, ?, ?, ?)",
+            (message_id, panel["guild"], panel["channel"], panel["cog"],
+             panel["kind"], json.dumps(panel["state"])))
+        self.database.commit()
+
+class TimerScheduler:
+    ''' Run jobs at a given time from a single timer heap
+        Pending jobs are stored in the database so they survive restarts
+        Message deletions which are due together are batched by channel
+'''
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot.database.execute(
+            "CREATE TABLE IF NOT EXISTS timers (id INTEGER PRIMARY KEY, "
+            "guild INTEGER, due REAL, kind TEXT, arguments TEXT)")
+        self.bot.database.commit()
+        self.heap = [
+            (due, job_id, kind, json.loads(arguments))
+            for job_id, guild, due, kind, arguments
+            in self.bot.database.execute(
+                "SELECT id, guild, due, kind, arguments FROM timers")
+            if self.bot.owns(guild)]
+        heapq.heapify(self.heap)
+        self.handlers = {"delete_message": self.delete_messages}
+        self.batched = {"delete_message"}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def register(self, kind, handler):
+        ''' Register the coroutine function which runs a kind of job
+'''
+        self.handlers[kind] = handler
+
+    def schedule(self, guild, delay, kind, **arguments):
+        ''' Schedule a job for a guild to run after a delay in seconds
+'''
+        due = time.time()+delay
+        cursor = self.bot.database.execute(
+            "INSERT INTO timers (guild, due, kind, arguments) "
+            "VALUES (?, ?, ?, ?)",
+            (guild.id, due, kind, json.dumps(arguments)))
+        self.bot.database.commit()
+        heapq.heappush(self.heap, (due, cursor.lastrowid, kind, arguments))
+        self.wakeup.set()
+
+    def delete_later(self, message, delay):
+        ''' Schedule a message to be deleted after a delay in seconds
+'''
+        self.schedule(
+            message.guild, delay, "delete_message",
+            channel=message.channel.id, message=message.id)
+
+    def start(self):
+        ''' Start running jobs if they are not already running
+'''
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        ''' Wait for the next job to be due and run all due jobs
+'''
+        while True:
+            now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+            if due:
+                asyncio.ensure_future(self.fire(due))
+                continue
+            timeout = self.heap[0][0]-now if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire(self, jobs):
+        ''' Run due jobs and remove them from the database
+'''
+        batches = {}
+        for _, job_id, kind, arguments in jobs:
+            if kind in self.batched:
+                batches.setdefault(kind, []).append(arguments)
+                continue
+            try:
+                await self.handlers[kind](**arguments)
+            except Exception as error:
+                logging.warning("Timer Failed: %s %r", kind, error)
+        for kind, batch in batches.items():
+            try:
+                await self.handlers[kind](batch)
+            except Exception as error:
+                logging.warning("Timer Failed: %s %r", kind, error)
+        self.bot.database.executemany(
+            "DELETE FROM timers WHERE id = ?", [(j[1],) for j in jobs])
+        self.bot.database.commit()
+
+    async def delete_messages(self, batch):
+        ''' Delete messages with one request per channel where possible
+'''
+        channels = {}
+        for arguments in batch:
+            channels.setdefault(arguments["channel"], []).append(
+                discord.Object(id=arguments["message"]))
+        for channel_id, messages in channels.items():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                continue
+            for i in range(0, len(messages), 100):
+                try:
+                    await channel.delete_messages(messages[i:i+100])
+                except discord.HTTPException as error:
+                    logging.warning("Message Deletion Failed: %r", error)
+
+class Metrics(commands.Cog):
+    ''' Record handler latencies, REST requests, and event loop lag
+        Metrics are served in the Prometheus text format
+'''
+    buckets = [
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10]
+
+    def __init__(self, bot, *, active, host, port, interval=1):
+        self.bot = bot
+        self.active = active
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.histograms = {}
+        self.requests = collections.Counter()
+        self.server = None
+        if self.active:
+            self.count_requests()
+
+    def observe(self, name, seconds):
+        ''' Add a duration to the histogram of a handler
+'''
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = {
+                "buckets": [0]*(len(self.buckets)+1), "sum": 0, "count": 0}
+        histogram["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    def quantile(self, name, fraction):
+        ''' Estimate a quantile of a histogram from its bucket bounds
+'''
+        histogram = self.histograms[name]
+        total = 0
+        for bound, count in zip(self.buckets, histogram["buckets"]):
+            total += count
+            if total >= fraction*histogram["count"]:
+                return bound
+        return float('inf')
+
+    def count_requests(self):
+        ''' Count the REST requests made by the bot by route
+'''
+        request = self.bot.http.request
+        async def counted_request(route, **kwargs):
+            self.requests[f"{route.method} {route.path}"] += 1
+            return await request(route, **kwargs)
+        self.bot.http.request = counted_request
+
+    async def start(self):
+        ''' Start the metrics endpoint and event loop lag monitor
+'''
+        if not self.active or self.server is not None:
+            return
+        self.server = await asyncio.start_server(
+            self.serve, self.host, self.port)
+        logging.info("Metrics: http://%s:%s", self.host, self.port)
+        asyncio.ensure_future(self.monitor_lag())
+
+    async def monitor_lag(self):
+        ''' Measure how late the event loop wakes up from a sleep
+'''
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.observe("event_loop_lag", loop.time()-start-self.interval)
+
+    async def serve(self, reader, writer):
+        ''' Respond to an HTTP request with the metrics
+'''
+        await reader.readline()
+        body = self.exposition().encode()
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n"
+            + body)
+        await writer.drain()
+        writer.close()
+
+    @staticmethod
+    def label(value):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return value.replace('\n', '\\n')
+
+    def exposition(self):
+        ''' Format the metrics in the Prometheus text format
+'''
+        lines = ["# TYPE utils_handler_seconds histogram"]
+        for name, histogram in sorted(self.histograms.items()):
+            label = f'handler="{self.label(name)}"'
+            total = 0
+            bounds = self.buckets+["+Inf"]
+            for bound, count in zip(bounds, histogram["buckets"]):
+                total += count
+                lines.append(
+                    f'utils_handler_seconds_bucket{{{label},le="{bound}"}} '
+                    f'{total}')
+            lines.append(
+                f'utils_handler_seconds_sum{{{label}}} {histogram["sum"]}')
+            lines.append(
+                f'utils_handler_seconds_count{{{label}}} '
+                f'{histogram["count"]}')
+        lines.append("# TYPE utils_rest_requests_total counter")
+        for route, count in sorted(self.requests.items()):
+            lines.append(
+                f'utils_rest_requests_total{{route="{self.label(route)}"}} '
+                f'{count}')
+        lines.append("# TYPE utils_gateway_latency_seconds gauge")
+        lines.append(f"utils_gateway_latency_seconds {self.bot.latency}")
+        lines.append("# TYPE utils_event_queue_depth gauge")
+        for guild_id, depth in self.bot.dispatcher.depths().items():
+            lines.append(
+                f'utils_event_queue_depth{{guild="{guild_id}"}} {depth}')
+        lines.append("# TYPE utils_events_dropped_total counter")
+        for guild_id, count in self.bot.dispatcher.dropped.items():
+            lines.append(
+                f'utils_events_dropped_total{{guild="{guild_id}"}} {count}')
+        return '\n'.join(lines)+'\n'
+
+    @commands.command(name="stats", pass_context=True)
+    @commands.is_owner()
+    async def stats(self, ctx):
+        ''' Send a summary of the bot metrics
+'''
+        embed = discord.Embed(title="Utils Metrics", color=0x00ff00)
+        if not self.active:
+            embed.add_field(name="Metrics", value="Metrics are not active")
+            await ctx.send(embed=embed)
+            return
+        handlers = sorted(
+            self.histograms, key=lambda n: -self.histograms[n]["count"])
+        fields = {
+            "Gateway Latency": f"{self.bot.latency*1000:.0f} ms",
+            "REST Requests": sum(self.requests.values()),
+            "Queued Events": sum(self.bot.dispatcher.depths().values()),
+            "Dropped Events": sum(self.bot.dispatcher.dropped.values())}
+        for name in handlers[:20]:
+            histogram = self.histograms[name]
+            fields[name] = '\n'.join([
+                f"Count: {histogram['count']}",
+                f"p50: {self.quantile(name, 0.5)*1000:g} ms",
+                f"p99: {self.quantile(name, 0.99)*1000:g} ms"])
+        for field in fields:
+            embed.add_field(name=field, value=fields[field])
+        await ctx.send(embed=embed)
+
+class MentionRecord:
+    ''' The parts of a message with mentions needed to report a ghost ping
+'''
+    __slots__ = (
+        "id", "guild", "channel", "author", "author_name", "everyone",
+        "roles", "members", "content", "expires")
+
+    def __init__(self, message, *, content, expires):
+        self.id = message.id
+        self.guild = message.guild.id
+        self.channel = message.channel.id
+        self.author = message.author.id
+        self.author_name = message.author.name
+        self.everyone = message.mention_everyone
+        self.roles = tuple(message.raw_role_mentions)
+        self.members = tuple(message.raw_mentions)
+        self.content = message.content[:content]
+        self.expires = expires
+
+class MentionCache:
+    ''' Keep the recent messages which mention everyone, roles, or members
+        Records expire after a time to live and the oldest are evicted
+'''
+    def __init__(self, *, ttl, capacity, content):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.content = content
+        self.records = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, message):
+        ''' Record a message and return the record
+'''
+        now = time.monotonic()
+        self.evict(now)
+        record = MentionRecord(
+            message, content=self.content, expires=now+self.ttl)
+        self.records[record.id] = record
+        return record
+
+    def pop(self, message_id):
+        ''' Remove the record of a message and return it if it is live
+'''
+        record = self.records.pop(message_id, None)
+        if record is None or record.expires < time.monotonic():
+            return None
+        return record
+
+    def evict(self, now):
+        ''' Remove expired records and the oldest records over capacity
+'''
+        records = self.records
+        while records and (
+                len(records) >= self.capacity
+                or next(iter(records.values())).expires < now):
+            records.popitem(last=False)
 
 class GhostPing(commands.Cog):
     ''' Detect if a memeber ghost pings a role, member, or everyone
+        Messages with mentions are cached so deletions can be checked from
+        raw events without the message cache of the client
 '''
     def __init__(self, bot):
         self.bot = bot
-        with open(os.path.join('data', 'ghost_ping.txt')) as file:
-            self.data = json.load(file)
+        self.bot.config.load("ghost_ping", self.compile_config)
+        self.mentions = MentionCache(**self.data["cache"])
+
+    @property
+    def data(self):
+        return self.bot.config["ghost_ping"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("ghost_ping", guild_id)
+
+    @staticmethod
+    def compile_config(data):
+        ''' Validate the categories of pings which are detected
+'''
+        config = {
+            k: bool(data[k]) for k in ("everyone", "roles", "members")}
+        config["cache"] = {
+            "ttl": float(data["cache"]["ttl"]),
+            "capacity": int(data["cache"]["capacity"]),
+            "content": int(data["cache"]["content"])}
+        return config
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is None:
+            return
+        data = self.guild_data(message.guild.id)
+        if (data["everyone"] and message.mention_everyone)\
+           or (data["roles"] and message.raw_role_mentions)\
+           or (data["members"] and message.raw_mentions):
+            self.mentions.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        log_event(
+            "message_delete", guild=payload.guild_id,
+            channel=payload.channel_id, message=payload.message_id)
+        record = self.mentions.pop(payload.message_id)
+        if record is not None:
+            await self.parse(record)
 
     @commands.Cog.listener()
-    async def on_message_delete(self, message):
-        logging.info("Message Delete: %s", message)
-        await self.parse(message)
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            record = self.mentions.pop(message_id)
+            if record is not None:
+                await self.parse(record)
 
-    async def parse(self, message):
+    @timed("GhostPing.parse")
+    async def parse(self, record):
         ''' Check all disallowed categories if the message mentions it
 '''
+        data = self.guild_data(record.guild)
+        guild = self.bot.get_guild(record.guild)
+        channel = self.bot.get_channel(record.channel)
+        if guild is None or channel is None:
+            return False
         pinged = []
         fields = {
-            "User": message.author.name, "Channel": message.channel.name,
-            "Message": message.content}
-        if self.data["everyone"]:
-            if message.mention_everyone:
+            "User": record.author_name, "Channel": channel.name,
+            "Message": record.content}
+        if data["everyone"]:
+            if record.everyone:
                 fields["Message @everyone"] = "Yes"
-            pinged.append(bool(message.mention_everyone))
-        if self.data["roles"]:
-            if message.raw_role_mentions:
-                fields["Role Mentions"] = ', '.join([
-                    discord.utils.get(message.guild.roles, id=i).name\
-                    for i in message.raw_role_mentions])
-            pinged.append(bool(message.raw_role_mentions))
-        if self.data["members"]:
-            if message.raw_mentions:
-                fields["Member Mentions"] = ', '.join(
-                    [discord.utils.get(message.guild.members, id=i).name\
-                     for i in message.raw_mentions])
-            pinged.append(bool(message.raw_mentions))
+            pinged.append(record.everyone)
+        if data["roles"]:
+            if record.roles:
+                fields["Role Mentions"] = ', '.join(
+                    self.bot.resolver.display(guild, "role", record.roles))
+            pinged.append(bool(record.roles))
+        if data["members"]:
+            if record.members:
+                fields["Member Mentions"] = ', '.join(self.bot.resolver.display(
+                    guild, "member", record.members))
+            pinged.append(bool(record.members))
         if not any(pinged):
             return False
+        log_event(
+            "moderation", action="ghost_ping", guild=record.guild,
+            channel=record.channel, message=record.id,
+            author=record.author)
         embed = discord.Embed(
             title="Ghost Ping Detected :no_entry_sign::ghost:",
             color=0xff0000)
         for field in fields:
-            embed.add_field(name=field, value=fields[field])
+            embed.add_field(name=field, value=fields[field] or "---")
         embed.set_footer(
             text=f"Detected At: {datetime.datetime.now().strftime('%D %T')}")
-        await message.channel.send(embed=embed)
+        await channel.send(embed=embed)
         return True
 
+class Ledger:
+    ''' Store the Guild Points and Bounty Tickets balances of members
+        Balances are cached in memory and written behind to the database
+        The balances of a guild are loaded when one of them is first used
+        Guild Points rankings are kept sorted once a guild is first ranked
+'''
+    units = {"points": 0, "tickets": 1}
+
+    def __init__(self, database, *, capacity=1000):
+        self.database = database
+        self.database.execute(
+            "CREATE TABLE IF NOT EXISTS ledger (guild INTEGER, "
+            "member INTEGER, points INTEGER, tickets INTEGER, "
+            "PRIMARY KEY (guild, member))")
+        self.database.commit()
+        self.balances = GuildCache(
+            self.load, capacity=capacity, evict=self.evict)
+        self.rankings = {}
+        self.dirty = set()
+
+    def load(self, guild_id):
+        ''' Read the balances of the members of a guild
+'''
+        return {
+            member: [points, tickets]
+            for member, points, tickets in self.database.execute(
+                "SELECT member, points, tickets FROM ledger "
+                "WHERE guild = ?", (guild_id,))}
+
+    def evict(self, guild_id, balances):
+        ''' Write the changed balances of a guild before it is evicted
+'''
+        self.rankings.pop(guild_id, None)
+        rows = [
+            (guild_id, member, *balances[member]) for member in balances
+            if (guild_id, member) in self.dirty]
+        if not rows:
+            return
+        self.dirty.difference_update((guild_id, r[1]) for r in rows)
+        self.database.executemany(
+            "INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?)", rows)
+        self.database.commit()
+
+    def __contains__(self, member):
+        return member.id in self.balances[member.guild.id]
+
+    def get(self, member, unit):
+        ''' Get the balance of a unit for a member
+'''
+        balance = self.balances[member.guild.id].get(member.id)
+        return 0 if balance is None else balance[self.units[unit]]
+
+    def set(self, member, unit, quantity):
+        ''' Set the balance of a unit for a member
+'''
+        balances = self.balances[member.guild.id]
+        balance = balances.setdefault(member.id, [0, 0])
+        ranking = self.rankings.get(member.guild.id)
+        if ranking is not None:
+            ranking.discard((-balance[0], member.id))
+        balance[self.units[unit]] = quantity
+        if ranking is not None:
+            ranking.add((-balance[0], member.id))
+        self.dirty.add((member.guild.id, member.id))
+
+    def add(self, member, unit, quantity):
+        ''' Add to the balance of a unit for a member
+            Return the old and new balances
+'''
+        old = self.get(member, unit)
+        self.set(member, unit, old+quantity)
+        return old, old+quantity
+
+    def ranking(self, guild_id):
+        ''' Get the members of a guild sorted by Guild Points
+            Entries are (-points, member ID) pairs
+'''
+        balances = self.balances[guild_id]
+        ranking = self.rankings.get(guild_id)
+        if ranking is None:
+            ranking = self.rankings[guild_id] = SortedList(
+                (-b[0], m) for m, b in balances.items())
+        return ranking
+
+    def top(self, guild_id, number):
+        ''' Get the IDs and Guild Points of the highest ranked members
+'''
+        return [(m, -p) for p, m in self.ranking(guild_id)[:number]]
+
+    def rank(self, member):
+        ''' Get the rank of a member by Guild Points
+            Members with the same points share a rank
+'''
+        points = self.get(member, "points")
+        return self.ranking(member.guild.id).bisect_left((-points,))+1
+
+    def write(self, members):
+        ''' Write the balances of members to the database now
+'''
+        rows = [
+            (m.guild.id, m.id, *self.balances[m.guild.id][m.id])
+            for m in members]
+        self.dirty.difference_update((r[0], r[1]) for r in rows)
+        self.database.executemany(
+            "INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?)", rows)
+        self.database.commit()
+
+    def flush(self):
+        ''' Write the changed balances to the database
+'''
+        if not self.dirty:
+            return
+        rows = [
+            (guild_id, member, *self.balances.peek(guild_id)[member])
+            for guild_id, member in self.dirty]
+        self.dirty.clear()
+        self.database.executemany(
+            "INSERT OR REPLACE INTO ledger VALUES (?, ?, ?, ?)", rows)
+        self.database.commit()
+
+class BountyEntries:
+    ''' Store the tickets each member entered in a bounty
+        Members are grouped by tickets so entering, withdrawing and drawing
+        a weighted winner take constant time for the nine ticket counts
+'''
+    def __init__(self):
+        self.tickets = {}
+        self.groups = {}
+        self.positions = {}
+        self.total = 0
+
+    def __contains__(self, member_id):
+        return member_id in self.tickets
+
+    def __len__(self):
+        return len(self.tickets)
+
+    def get(self, member_id):
+        return self.tickets.get(member_id)
+
+    def enter(self, member_id, tickets):
+        ''' Enter a member with a number of tickets
+'''
+        group = self.groups.setdefault(tickets, [])
+        self.positions[member_id] = len(group)
+        group.append(member_id)
+        self.tickets[member_id] = tickets
+        self.total += tickets
+
+    def withdraw(self, member_id):
+        ''' Remove the entry of a member and return its tickets
+'''
+        tickets = self.tickets.pop(member_id)
+        group = self.groups[tickets]
+        #Move the last member of the group into the removed position
+        last = group.pop()
+        position = self.positions.pop(member_id)
+        if last != member_id:
+            group[position] = last
+            self.positions[last] = position
+        if not group:
+            del self.groups[tickets]
+        self.total -= tickets
+        return tickets
+
+    def draw(self, number=1):
+        ''' Draw winners weighted by their tickets without replacement
+            The winners are removed from the entries
+'''
+        winners = []
+        while self.total and len(winners) < number:
+            target = random.randrange(self.total)
+            for tickets, group in self.groups.items():
+                weight = tickets*len(group)
+                if target < weight:
+                    winner = group[target//tickets]
+                    break
+                target -= weight
+            self.withdraw(winner)
+            winners.append(winner)
+        return winners
+
+class TierEngine:
+    ''' Resolve Guild Point tiers with bisect on the sorted thresholds
+        Tier roles are cached until the role is updated or deleted
+'''
+    def __init__(self):
+        self.roles = {}
+
+    @staticmethod
+    def reached(tiers, points):
+        ''' Get the number of tiers reached with a number of points
+'''
+        return bisect.bisect_right(tiers["thresholds"], points)
+
+    @staticmethod
+    def crossed(tiers, old, new):
+        ''' Get the indexes of the tiers reached between two balances
+'''
+        thresholds = tiers["thresholds"]
+        return range(
+            bisect.bisect_right(thresholds, old),
+            bisect.bisect_right(thresholds, new))
+
+    def role(self, guild, tiers, index):
+        ''' Get the role of a tier in a guild
+'''
+        role_id = tiers["roles"][index]
+        role = self.roles.get(role_id)
+        if role is None:
+            role = guild.get_role(role_id)
+            if role is not None:
+                self.roles[role_id] = role
+        return role
+
+    def invalidate(self, role):
+        self.roles.pop(role.id, None)
+
 class GuildPoints(commands.Cog):
     ''' Manage Guild Points and Bounty Tickets which can be awarded to members
 '''
-    def __init__(self, bot, *, channel="general"):
+    def __init__(self, bot):
         self.bot = bot
-        with open(os.path.join('data', 'guild_points.txt')) as file:
-            self.data = json.load(file)
-        self.data['tiers'] = {
-            int(k):int(v) for k, v in self.data['tiers'].items()}
-        self.point_regex = re.compile(r'_Guild Points: ([0-9]+)_')
-        self.ticket_regex = re.compile(r'_Bounty Tickets: ([0-9]+)_')
-        self.channel = channel
+        self.bot.config.load(
+            "guild_points", self.compile_config, self.reload_config)
+        #Balances used to be stored in role names
+        self.legacy_regexes = {
+            "points": re.compile(r'_Guild Points: ([0-9]+)_'),
+            "tickets": re.compile(r'_Bounty Tickets: ([0-9]+)_')}
+        self.ledger = Ledger(
+            bot.database, capacity=bot.data["guilds"]["capacity"])
+        self.tiers = TierEngine()
+        self.tier_syncs = collections.OrderedDict()
+        self.imported = set()
+        self.bot.loop.create_task(self.flush_ledger())
+        self.sync_task = None
+        if self.data["sync"]["active"]:
+            self.start_sync()
         self.bounty_reactions = [
             u"\u0031\ufe0f\u20e3", u"\u0032\ufe0f\u20e3",
             u"\u0033\ufe0f\u20e3", u"\u0034\ufe0f\u20e3",
             u"\u0035\ufe0f\u20e3", u"\u0036\ufe0f\u20e3",
             u"\u0037\ufe0f\u20e3", u"\u0038\ufe0f\u20e3",
             u"\u0039\ufe0f\u20e3"]
-        self.bounty_entries = {}
+        #Bounty entries are stored so a restart does not lose live bounties
+        self.bot.database.execute(
+            "CREATE TABLE IF NOT EXISTS bounty_entries (message INTEGER, "
+            "member INTEGER, tickets INTEGER, PRIMARY KEY (message, member))")
+        self.bot.database.commit()
+        self.bounties = {}
+        for message_id, member_id, tickets in self.bot.database.execute(
+                "SELECT message, member, tickets FROM bounty_entries"):
+            if self.bot.panels.get(message_id, "GuildPoints") is not None:
+                self.bounties.setdefault(
+                    message_id, BountyEntries()).enter(member_id, tickets)
+        self.bot.timers.register("award_bounty", self.award_bounty)
+
+    @property
+    def data(self):
+        return self.bot.config["guild_points"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("guild_points", guild_id)
+
+    @staticmethod
+    def compile_config(data):
+        ''' Sort the tiers by points and validate the sync settings
+'''
+        tiers = sorted((int(k), int(v)) for k, v in data["tiers"].items())
+        rate = float(data["sync"]["rate"])
+        if rate <= 0:
+            raise ValueError("sync rate must be positive")
+        draw = {k: int(data["draw"][k]) for k in ("minimum", "winners")}
+        if draw["winners"] < 1:
+            raise ValueError("bounties must have a winner")
+        return {
+            "thresholds": [pts for pts, _ in tiers],
+            "roles": [role for _, role in tiers],
+            "bounty": int(data["bounty"]),
+            "draw": draw,
+            "sync": {"active": bool(data["sync"]["active"]), "rate": rate}}
+
+    def reload_config(self, old, new):
+        ''' Start syncing tier roles if the sync was activated
+'''
+        if new["sync"]["active"]:
+            self.start_sync()
+
+    def start_sync(self):
+        ''' Start syncing tier roles if the sync is not running
+'''
+        if self.sync_task is None or self.sync_task.done():
+            self.sync_task = self.bot.loop.create_task(self.sync_tiers())
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot:
             return
-        members = [m for m in message.guild.members if not m.bot]
         if message.author == random.choice(message.guild.members):
             await self.award_tickets(message)
             if message.channel == random.choice(message.guild.channels):
@@ -165,50 +1776,46 @@ class GuildPoints(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
-        if payload.member.bot:
-            return
-        channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        embed = message.embeds[0]
-        if embed.footer.text != "GuildPoints":
+        panel = self.bot.panels.get(payload.message_id, "GuildPoints")
+        if panel is None or payload.member.bot:
             return
         if payload.emoji.name == u"\u274c":
             await self.withdraw_entry(payload)
         elif payload.emoji.name in self.bounty_reactions:
             await self.enter_bounty(payload)
 
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        self.tiers.invalidate(after)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        self.tiers.invalidate(role)
+
     @commands.command(name="points", pass_context=True, aliases=["p"])
+    @timed("GuildPoints.points")
     async def points(self, ctx):
         ''' Get number of Guild Points a member has
 '''
         if await self.bot.check_commands(ctx):
             return
-        #Parse through members roles to get current points
-        points = 0
-        for role in ctx.message.author.roles:
-            if self.point_regex.search(role.name) is not None:
-                points = int(self.point_regex.search(role.name).group(1))
-                break
+        points = self.balance(ctx.author, "points")
+        data = self.guild_data(ctx.guild.id)
         #Get tier information from points
-        tiers = ["---", "---"]
-        for pts in self.data["tiers"]:
-            if pts <= points:
-                tiers[0] = discord.utils.get(
-                    ctx.guild.roles, id=self.data["tiers"][pts]).name
-            elif pts > points:
-                tiers[1] = discord.utils.get(
-                    ctx.guild.roles, id=self.data["tiers"][pts]).name
-                diff = pts-points
-                break
-        if points >= 100:
-            tiers[1] = '---'
-            diff = '---'
+        reached = self.tiers.reached(data, points)
+        role, upcoming, diff = None, None, '---'
+        if reached:
+            role = self.tiers.role(ctx.guild, data, reached-1)
+        if reached < len(data["thresholds"]):
+            upcoming = self.tiers.role(ctx.guild, data, reached)
+            diff = data["thresholds"][reached]-points
         #Send point and tier information
-        role = discord.utils.get(ctx.guild.roles, name=tiers[0])
         color = 0x00ff00 if role is None else role.color
         fields = {
-            "Points": points, "Current Tier": tiers[0],
-            "Next Tier": tiers[1], "Points until next tier": diff}
+            "Points": points,
+            "Current Tier": '---' if role is None else role.name,
+            "Next Tier": '---' if upcoming is None else upcoming.name,
+            "Points until next tier": diff}
         embed = discord.Embed(
             title=f"{ctx.author.name}'s Guild points",
             color=color)
@@ -219,17 +1826,13 @@ class GuildPoints(commands.Cog):
         await ctx.send(embed=embed)
 
     @commands.command(name="tickets", pass_context=True, aliases=["t"])
+    @timed("GuildPoints.tickets")
     async def tickets(self, ctx):
         ''' Get number of Bounty Tickets a member has
 '''
         if await self.bot.check_commands(ctx):
             return
-        #Parse through member roles to get current tickets
-        tickets = 0
-        for role in ctx.author.roles:
-            if self.ticket_regex.search(role.name) is not None:
-                tickets = int(self.ticket_regex.search(role.name).group(1))
-                break
+        tickets = self.balance(ctx.author, "tickets")
         #Send ticket information
         fields = {
             "Tickets": tickets}
@@ -241,86 +1844,187 @@ class GuildPoints(commands.Cog):
         await ctx.send(embed=embed)
 
     @commands.command(name="give", pass_context=True, aliases=["g"])
-    async def give(self, ctx, unit, member, quantity):
-        ''' Give Guild Points or Bounty Tickets to a member
+    @timed("GuildPoints.give")
+    async def give(self, ctx, unit, *targets):
+        ''' Give Guild Points or Bounty Tickets to members
+            Members can be mentioned directly, by role, or by voice channel
+            The last argument is the quantity given to each member
 '''
         if await self.bot.check_commands(ctx):
             return
-        unit = unit.lower()[0]
-        if unit == 'p':
-            regex = self.point_regex
-        elif unit == 't':
-            regex = self.ticket_regex
-        else:
+        units = {'p': "points", 't': "tickets"}
+        unit = units.get(unit.lower()[0])
+        if unit is None:
             await ctx.send("You can only give points or tickets")
             await ctx.message.delete()
             return
-        if not ctx.message.raw_mentions:
+        try:
+            quantity = int(float(targets[-1]))
+        except (IndexError, ValueError):
+            await ctx.send("You have to give a quantity")
+            await ctx.message.delete()
+            return
+        members = self.resolve_targets(ctx.message)
+        if not members:
             await ctx.send("You have to mention someone")
             await ctx.message.delete()
             return
-        member = discord.utils.get(
-            ctx.guild.members, id=ctx.message.raw_mentions[0])
-        units, quantity = 0, int(float(quantity))
-        for role in member.roles:
-            if regex.search(role.name):
-                units = int(regex.search(role.name).group(1))
-                break
-        new_units = units + quantity
-        currency = "Guild Points" if unit == 'p' else "Bounty Tickets"
-        names = [f"_{currency}: {units}_",
-                 f"_{currency}: {new_units}_"]
-        await self.guild_currency(member, names)
-        if unit == 'p':
-            await self.parse_tiers(member, [units, new_units])
+        balances, errors, warnings = await self.give_many(
+            members, unit, quantity)
+        #Send a summary of the changed balances
+        given = [
+            f"{m.name}: {new}"+(" (tier not updated)" if m in warnings else '')
+            for m, (_, new) in balances.items()]
+        failed = [f"{m.name}: {error}" for m, error in errors.items()]
+        embed = discord.Embed(
+            title=f"Gave {quantity} {unit.title()}", color=0x00ff00)
+        embed.add_field(name="Members", value=len(members))
+        if given:
+            embed.add_field(name="New Balances", value=self.summarize(given))
+        if failed:
+            embed.add_field(name="Failed", value=self.summarize(failed))
+        await ctx.send(embed=embed)
+
+    def resolve_targets(self, message):
+        ''' Get the members mentioned, with a mentioned role, or in a
+            mentioned voice channel
+'''
+        guild = message.guild
+        member_ids = set(message.raw_mentions)
+        grouped = set()
+        for role_id in message.raw_role_mentions:
+            role = guild.get_role(role_id)
+            if role is not None:
+                grouped |= self.bot.role_index.member_ids(role)
+        for channel_id in message.raw_channel_mentions:
+            channel = guild.get_channel(channel_id)
+            if isinstance(channel, discord.VoiceChannel):
+                grouped.update(m.id for m in channel.members)
+        members = [guild.get_member(i) for i in member_ids]
+        #Bots are only given to when they are mentioned directly
+        for member_id in grouped-member_ids:
+            member = guild.get_member(member_id)
+            if member is not None and not member.bot:
+                members.append(member)
+        return [m for m in members if m is not None]
+
+    async def give_many(self, members, unit, quantity):
+        ''' Change the balances of many members at once
+            Return the old and new balances and the errors of each member,
+            and the errors of the tier notifications of changed balances
+'''
+        balances, errors, warnings = {}, {}, {}
+        for member in members:
+            try:
+                self.balance(member, unit)
+                balances[member] = self.ledger.add(member, unit, quantity)
+            except Exception as error:
+                errors[member] = error
+        if unit != "points":
+            return balances, errors, warnings
+        for member, ptrange in balances.items():
+            try:
+                await self.parse_tiers(member, ptrange)
+            except Exception as error:
+                logging.warning("Tier Notification Failed: %r", error)
+                warnings[member] = error
+        return balances, errors, warnings
+
+    @staticmethod
+    def summarize(lines, *, limit=1024):
+        ''' Join lines for an embed field value within its length limit
+'''
+        value = ''
+        for count, line in enumerate(lines):
+            more = f"\n...and {len(lines)-count} more"
+            if len(value)+len(line)+1+len(more) > limit:
+                return value+more
+            value += ('\n' if value else '')+line
+        return value
+
+    @commands.command(name="leaderboard", pass_context=True, aliases=["lb"])
+    @timed("GuildPoints.leaderboard")
+    async def leaderboard(self, ctx):
+        ''' Get the members with the most Guild Points
+'''
+        if await self.bot.check_commands(ctx):
+            return
+        self.import_legacy(ctx.guild)
+        #Send the ranks of the top members
+        lines = []
+        for rank, (member_id, points) in enumerate(
+                self.ledger.top(ctx.guild.id, 10), start=1):
+            member = ctx.guild.get_member(member_id)
+            name = f"<@{member_id}>" if member is None else member.name
+            lines.append(f"{rank}. {name} - {points}")
+        embed = discord.Embed(
+            title=f"{ctx.guild.name} Guild Points Leaderboard",
+            color=0x00ff00)
+        embed.add_field(
+            name="Top Members", value='\n'.join(lines) or "---")
+        await ctx.send(embed=embed)
+
+    @commands.command(name="rank", pass_context=True, aliases=["r"])
+    @timed("GuildPoints.rank")
+    async def rank(self, ctx):
+        ''' Get the Guild Points rank of the mentioned member or the author
+'''
+        if await self.bot.check_commands(ctx):
+            return
+        member = ctx.author
+        if ctx.message.raw_mentions:
+            member = ctx.guild.get_member(ctx.message.raw_mentions[0])
+        if member is None:
+            await ctx.send("That member is not in this server")
+            return
+        self.import_legacy(ctx.guild)
+        points = self.balance(member, "points")
+        #Send rank information
+        fields = {
+            "Rank": self.ledger.rank(member), "Points": points}
+        embed = discord.Embed(
+            title=f"{member.name}'s Guild Points Rank",
+            color=0x00ff00)
+        for field in fields:
+            embed.add_field(name=field, value=fields[field])
+        await ctx.send(embed=embed)
 
     async def award_tickets(self, message):
         ''' Award a random number of tickets to a member
 '''
-        #Parse through member roles to get the number of tickets
-        tickets = 0
-        for role in message.author.roles:
-            if self.ticket_regex.search(role.name):
-                tickets = int(self.ticket_regex.search(role.name).group(1))
-                break
         #Award a random number of tickets
         plus = random.choices(
             list(range(1, 10)),
             [(1/2)**n for n in range(1, 10)])[0]
-        new_tickets = tickets + plus
-        names = [f"_Bounty Tickets: {tickets}_",
-                 f"_Bounty Tickets: {new_tickets}_"]
-        await self.guild_currency(message.author, names)
+        _, new_tickets = await self.guild_currency(
+            message.author, "tickets", plus)
         #Notify member
-        direct_message = await message.author.create_dm()
         embed = discord.Embed(
             title=f"Awarded {plus} Bounty Tickets", color=0x00ff00)
         embed.add_field(name="Total Tickets", value=new_tickets)
-        await direct_message.send(embed=embed)
+        self.bot.notifier.notify(message.author, embed)
 
     async def enter_bounty(self, payload):
         ''' Enter a Guild Point Bounty with a number of tickets
 '''
         #Get information from payload
         channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        direct_message = await payload.member.create_dm()
+        message = channel.get_partial_message(payload.message_id)
         #Verify member has not already entered bounty
-        if payload.member.id in self.bounty_entries:
+        bounty = self.bounties.setdefault(
+            payload.message_id, BountyEntries())
+        if payload.member.id in bounty:
             embed = discord.Embed(
                 title="You have already entered that bounty!", color=0x00ff00)
             embed.add_field(
                 name="Withdraw Entry",
                 value="React with :x: to get tickets refunded")
-            await direct_message.send(embed=embed)
-            await message.remove_reaction(payload.emoji, payload.member)
+            self.bot.notifier.notify(payload.member, embed)
+            self.bot.actions.remove_reaction(
+                message, payload.emoji, payload.member)
             return
         #Get the current number of tickets member has
-        tickets = 0
-        for role in payload.member.roles:
-            if self.ticket_regex.search(role.name):
-                tickets = int(self.ticket_regex.search(role.name).group(1))
-                break
+        tickets = self.balance(payload.member, "tickets")
         #Verify member has enough tickets to enter
         entries = self.bounty_reactions.index(payload.emoji.name)+1
         if entries > tickets:
@@ -328,15 +2032,18 @@ class GuildPoints(commands.Cog):
                 title="You don't have enough tickets!",
                 color=0xff0000)
             embed.add_field(name="Tickets", value=tickets)
-            await direct_message.send(embed=embed)
-            await message.remove_reaction(payload.emoji, payload.member)
+            self.bot.notifier.notify(payload.member, embed)
+            self.bot.actions.remove_reaction(
+                message, payload.emoji, payload.member)
             return
-        new_tickets = tickets - entries
-        names = [f"_Bounty Tickets: {tickets}_",
-                 f"_Bounty Tickets: {new_tickets}_"]
-        await self.guild_currency(payload.member, names)
+        _, new_tickets = await self.guild_currency(
+            payload.member, "tickets", -entries)
         #Enter member in bounty and notify member
-        self.bounty_entries.setdefault(payload.member.id, entries)
+        bounty.enter(payload.member.id, entries)
+        self.bot.database.execute(
+            "INSERT OR REPLACE INTO bounty_entries VALUES (?, ?, ?)",
+            (payload.message_id, payload.member.id, entries))
+        self.bot.database.commit()
         embed = discord.Embed(
             title="Bounty Entry Successful", color=0x00ff00)
         embed.add_field(name="Entries", value=entries)
@@ -344,44 +2051,44 @@ class GuildPoints(commands.Cog):
             name="Widthdraw Entry",
             value="React with :x: to get tickets refunded")
         embed.add_field(name="Tickets", value=new_tickets)
-        await direct_message.send(embed=embed)
+        self.bot.notifier.notify(payload.member, embed)
 
     async def withdraw_entry(self, payload):
         ''' Withdraw all entries in a Guild Points Bounty and refund tickets
 '''
         #Get information from payload
         channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        direct_message = await payload.member.create_dm()
+        message = channel.get_partial_message(payload.message_id)
         #Get tickets used by member
-        entries = self.bounty_entries.get(payload.member.id)
-        if entries is None:
-            return
-        await message.remove_reaction(
-            self.bounty_reactions[entries-1], payload.member)
-        await message.remove_reaction(
-            payload.emoji, payload.member)
-        del self.bounty_entries[payload.member.id]
-        #Get number of tickets member has
-        tickets = 0
-        for role in payload.member.roles:
-            if self.ticket_regex.search(role.name):
-                tickets = int(self.ticket_regex.search(role.name).group(1))
-                break
+        bounty = self.bounties.get(payload.message_id)
+        if bounty is None or payload.member.id not in bounty:
+            return
+        entries = bounty.withdraw(payload.member.id)
+        self.bot.database.execute(
+            "DELETE FROM bounty_entries WHERE message = ? AND member = ?",
+            (payload.message_id, payload.member.id))
+        self.bot.database.commit()
+        self.bot.actions.remove_reaction(
+            message, self.bounty_reactions[entries-1], payload.member)
+        self.bot.actions.remove_reaction(
+            message, payload.emoji, payload.member)
         #Refund tickets to member
-        new_tickets = tickets + entries
-        names = [f"_Bounty Tickets: {tickets}_",
-                 f"_Bounty Tickets: {new_tickets}_"]
-        await self.guild_currency(payload.member, names)
+        _, new_tickets = await self.guild_currency(
+            payload.member, "tickets", entries)
         #Notify member
         embed = discord.Embed(
             title="Bounty Withdrawl Successful", color=0x00ff00)
         embed.add_field(name="Tickets", value=new_tickets)
-        await direct_message.send(embed=embed)
+        self.bot.notifier.notify(payload.member, embed)
 
     async def create_bounty(self, message):
         ''' Create a Guild Point Bounty for members to enter in
 '''
+        channel = self.bot.resolver.channel(
+            message.guild, self.guild_data(message.guild.id)["bounty"])
+        if channel is None:
+            logging.warning("Bounty Channel Not Found: %s", message.guild.id)
+            return
         start = datetime.datetime.now()
         end = start+datetime.timedelta(minutes=1)
         embed = discord.Embed(title="New Bounty!", color=0x00ff00)
@@ -393,110 +2100,418 @@ class GuildPoints(commands.Cog):
         for field in fields:
             embed.add_field(name=field, value=fields[field])
         embed.set_footer(text="GuildPoints")
-        channel = discord.utils.get(message.guild.channels, name=self.channel)
         bounty = await channel.send(embed=embed)
+        self.bot.panels.register(
+            bounty, "GuildPoints", "bounty", end=end.timestamp())
+        self.bounties[bounty.id] = BountyEntries()
         #Add reactions for members to enter
-        for emoji in self.bounty_reactions:
-            await bounty.add_reaction(emoji)
-        await bounty.add_reaction(u"\u274c")
-        #Wait until the bounty has ended
-        time_left = (end-datetime.datetime.now()).total_seconds()
-        while time_left > 0:
-            time_left = (end-datetime.datetime.now()).total_seconds()
-            await asyncio.sleep(1)
-        await self.award_bounty(bounty)
-
-    async def award_bounty(self, message):
-        ''' Award a random number of Guild Points to a random member
-'''
-        channel = discord.utils.get(
-            message.guild.channels, id=self.data["bounty"])
-        message = await channel.fetch_message(message.id)
-        #Randomly select a winner and the number of points won
-        await message.clear_reactions()
+        self.bot.actions.add_reactions(
+            bounty, self.bounty_reactions+[u"\u274c"])
+        #Award the bounty once it has ended
+        self.bot.timers.schedule(
+            message.guild, (end-start).total_seconds(), "award_bounty",
+            channel=channel.id, message=bounty.id)
+
+    async def award_bounty(self, channel, message):
+        ''' Award a random number of Guild Points to random members
+            Members are drawn with a weight of the tickets they entered
+'''
+        channel = self.bot.get_channel(channel)
+        message = channel.get_partial_message(message)
+        self.bot.panels.remove(message.id)
+        entries = self.bounties.pop(message.id, BountyEntries())
+        self.bot.database.execute(
+            "DELETE FROM bounty_entries WHERE message = ?", (message.id,))
+        self.bot.database.commit()
+        draw = self.guild_data(channel.guild.id)["draw"]
+        #Randomly select the winners and the number of points won
+        self.bot.actions.clear_reactions(message)
         embed = discord.Embed(title="Bounty Awarded", color=0x00ff00)
-        if sum(list(self.bounties.values())) < 15:
+        if entries.total < draw["minimum"]:
             embed.add_field(
                 name="No Winner", value="Not Enough Bounty Entries")
             await message.edit(embed=embed)
             return
-        bounty = {
-            "Winner": discord.utils.get(
-                message.guild.members,
-                id=random.choices(
-                    list(self.bounty_entries),
-                    list(self.bounty_entries.values()))[0]),
-            "Points": random.choices(
+        winners = []
+        for member_id in entries.draw(draw["winners"]):
+            member = channel.guild.get_member(member_id)
+            if member is None:
+                continue
+            points = random.choices(
                 list(range(1, 11)),
-                [(1/2)**n for n in range(1, 11)])[0]}
-        embed.add_field(name="Winner", value=bounty["Winner"].name)
-        embed.add_field(name="Points", value=bounty["Points"])
+                [(1/2)**n for n in range(1, 11)])[0]
+            winners.append((member, points))
+        embed.add_field(
+            name="Winners" if len(winners) > 1 else "Winner",
+            value='\n'.join([m.name for m, _ in winners]) or "---")
+        embed.add_field(
+            name="Points",
+            value='\n'.join([str(p) for _, p in winners]) or "---")
         await message.edit(embed=embed)
-        #Add points to member
-        points = 0
-        for role in bounty["Winner"].roles:
-            if self.point_regex.search(role.name):
-                points = int(self.point_regex.search(role.name).group(1))
-                break
-        new_points = points + bounty["Points"]
-        names = [f"_Guild Points: {points}_",
-                 f"_Guild Points: {new_points}_"]
-        await self.guild_currency(bounty["Winner"], names)
-        await self.parse_tiers(bounty["Winner"], [points, new_points])
-
-    async def guild_currency(self, member, names):
-        ''' Manage the number of Guild Points or Bounty Tickets a member has
-'''
-        #Get new and old roles
-        old = discord.utils.get(member.guild.roles, name=names[0])
-        new = discord.utils.get(member.guild.roles, name=names[1])
-        #Create new role if does not already exist
-        if new is None:
-            await member.guild.create_role(name=names[1])
-            new = discord.utils.get(member.guild.roles, name=names[1])
-        #Add new role and remove old role from member roles
-        await member.add_roles(new)
-        if old is not None:
-            await member.remove_roles(old)
-        #Delete old role if no other member has it
-        delete = True
-        for mem in member.guild.members:
-            if old in mem.roles:
-                delete = False
-                break
-        if old and delete:
-            await old.delete()
+        #Add points to members
+        for member, points in winners:
+            await self.guild_currency(member, "points", points)
+
+    def balance(self, member, unit):
+        ''' Get the number of Guild Points or Bounty Tickets a member has
+            Balances stored in legacy role names are imported once
+'''
+        if member not in self.ledger:
+            legacy = self.import_balance(member)
+            if legacy:
+                #The balance is written before its roles are removed so it
+                #cannot be lost if the bot stops before the next flush
+                self.ledger.write([member])
+                self.bot.loop.create_task(
+                    self.retire_legacy_roles(member, legacy))
+        return self.ledger.get(member, unit)
+
+    def import_balance(self, member):
+        ''' Set the balances of a member from their legacy role names
+            Return the legacy roles the balances were read from
+'''
+        legacy = []
+        for name, regex in self.legacy_regexes.items():
+            for role in member.roles:
+                match = regex.search(role.name)
+                if match is not None:
+                    self.ledger.set(member, name, int(match.group(1)))
+                    legacy.append(role)
+                    break
+            else:
+                self.ledger.set(member, name, 0)
+        return legacy
+
+    def import_legacy(self, guild):
+        ''' Import the legacy balances of every member of a guild once
+            Rankings then include members who have not used Guild Points
+            since their balances were stored in role names
+            The legacy roles are removed in the background in batches
+'''
+        if guild.id in self.imported:
+            return
+        self.imported.add(guild.id)
+        migrations = []
+        for role in guild.roles:
+            if not any(
+                    r.search(role.name) for r in self.legacy_regexes.values()):
+                continue
+            for member_id in list(self.bot.role_index.member_ids(role)):
+                member = guild.get_member(member_id)
+                if member is None or member in self.ledger:
+                    continue
+                legacy = self.import_balance(member)
+                if legacy:
+                    migrations.append((member, legacy))
+        if migrations:
+            self.ledger.write([m for m, _ in migrations])
+            self.bot.loop.create_task(self.migrate_legacy(guild, migrations))
+
+    async def migrate_legacy(self, guild, migrations, *, batch=50):
+        ''' Remove the legacy roles of many members in batches
+            Orphaned legacy roles are deleted once every batch is done
+'''
+        roles = set()
+        for i in range(0, len(migrations), batch):
+            members = migrations[i:i+batch]
+            results = await asyncio.gather(return_exceptions=True, *[
+                self.bot.actions.edit_roles(member, remove=legacy)
+                for member, legacy in members])
+            for (member, legacy), result in zip(members, results):
+                if not isinstance(result, Exception):
+                    self.bot.role_index.remove(member, legacy)
+                    roles.update(legacy)
+            logging.info(
+                "Migrating Legacy Balances: %s: %s/%s members", guild.id,
+                min(i+batch, len(migrations)), len(migrations))
+        await self.delete_orphaned(roles)
+
+    async def retire_legacy_roles(self, member, roles):
+        ''' Remove legacy balance roles from a member
+            Delete the roles if no other member has them
+'''
+        await self.bot.actions.edit_roles(member, remove=roles)
+        self.bot.role_index.remove(member, roles)
+        await self.delete_orphaned(roles)
+
+    async def delete_orphaned(self, roles):
+        ''' Delete the legacy roles which no member has
+'''
+        for role in roles:
+            if self.bot.role_index.is_orphaned(role):
+                try:
+                    await role.delete()
+                except discord.NotFound:
+                    #Another member's migration deleted the role first
+                    pass
+
+    async def guild_currency(self, member, unit, quantity):
+        ''' Change the number of Guild Points or Bounty Tickets a member has
+            Return the old and new balances
+'''
+        old = self.balance(member, unit)
+        _, new = self.ledger.add(member, unit, quantity)
+        if unit == "points":
+            await self.parse_tiers(member, [old, new])
+        return old, new
+
+    async def flush_ledger(self, *, interval=10):
+        ''' Periodically write cached balances to the database
+'''
+        while True:
+            await asyncio.sleep(interval)
+            self.ledger.flush()
 
     async def parse_tiers(self, member, ptrange):
         ''' Check if a member achieved a new Guild Point tier
 '''
-        for pts in self.data["tiers"]:
-            if ptrange[0] < pts <= ptrange[1]:
-                new_tier = self.data["tiers"][pts]
-                role = discord.utils.get(member.guild.roles, id=new_tier)
-                divider = discord.utils.get(
-                    member.guild.roles, name='__________ Tiers __________')
-                if divider is None:
-                    await member.guild.create_role(
-                        name='__________ Tiers __________')
-                    divider = discord.utils.get(
-                    member.guild.roles, name='__________ Tiers __________')
-                await member.add_roles(divider)
-                color = 0x00ff00 if role is None else role.color
-                direct_message = await member.create_dm()
-                embed = discord.Embed(
-                    title="New Tier Reached!", color=color)
-                embed.add_field(name="New Role", value=role.name)
-                await member.add_roles(role)
-                await direct_message.send(embed=embed)
+        data = self.guild_data(member.guild.id)
+        for index in self.tiers.crossed(data, *ptrange):
+            role = self.tiers.role(member.guild, data, index)
+            if role is None:
+                continue
+            embed = discord.Embed(
+                title="New Tier Reached!", color=role.color)
+            embed.add_field(name="New Role", value=role.name)
+            self.bot.notifier.notify(member, embed)
+            #Tier roles are granted by the rate-limited tier sync
+            if self.guild_data(member.guild.id)["sync"]["active"]:
+                key = (member.guild.id, member.id)
+                self.tier_syncs[key] = None
+                self.tier_syncs.move_to_end(key)
+                self.start_sync()
+
+    async def sync_tiers(self):
+        ''' Grant members the tier roles for their Guild Points
+            Members are synced one at a time at the configured rate
+            Guilds choose if their members are synced but the rate is
+            bot-wide, so it is always read from the global config
+'''
+        await self.bot.wait_until_ready()
+        while True:
+            await asyncio.sleep(1/self.data["sync"]["rate"])
+            if not self.tier_syncs:
+                continue
+            (guild_id, member_id), _ = self.tier_syncs.popitem(last=False)
+            guild = self.bot.get_guild(guild_id)
+            member = None if guild is None else guild.get_member(member_id)
+            if member is None:
+                continue
+            try:
+                await self.grant_tiers(member)
+            except discord.HTTPException as error:
+                logging.warning("Tier Sync Failed: %s", error)
+
+    async def grant_tiers(self, member):
+        ''' Add all tier roles reached by a member that they are missing
+'''
+        points = self.ledger.get(member, "points")
+        data = self.guild_data(member.guild.id)
+        roles = [
+            self.tiers.role(member.guild, data, i)
+            for i in range(self.tiers.reached(data, points))]
+        roles = [r for r in roles if r is not None and r not in member.roles]
+        if not roles:
+            return
+        divider = self.bot.resolver.find(
+            member.guild, "role", '__________ Tiers __________')
+        if divider is None:
+            divider = await member.guild.create_role(
+                name='__________ Tiers __________')
+        if divider not in member.roles:
+            roles.append(divider)
+        await self.bot.actions.edit_roles(member, add=roles)
+
+class SpamTracker:
+    ''' Track the recent messages of each author in each channel
+        Messages are kept in bounded ring buffers of (timestamp, ID) pairs
+        Authors idle for longer than the time interval are evicted
+'''
+    def __init__(self, max_num, max_int, *, capacity=10000):
+        self.max_num = max_num
+        self.max_int = max_int
+        self.capacity = capacity
+        self.buckets = collections.OrderedDict()
+
+    def track(self, message):
+        ''' Record a message and return the IDs of the tracked messages
+            An empty list is returned if the author is not spamming
+'''
+        guild_id = message.guild.id if message.guild is not None else None
+        key = (guild_id, message.channel.id, message.author.id)
+        stamp = message.created_at.timestamp()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = collections.deque(maxlen=self.max_num+1)
+            self.buckets[key] = bucket
+        else:
+            self.buckets.move_to_end(key)
+        #Drop messages sent before the time interval
+        while bucket and stamp-bucket[0][0] > self.max_int:
+            bucket.popleft()
+        bucket.append((stamp, message.id))
+        self.evict(stamp)
+        if len(bucket) <= self.max_num:
+            return []
+        del self.buckets[key]
+        return [i for _, i in bucket]
+
+    def evict(self, now):
+        ''' Evict the least recently active authors
+            Authors are evicted if idle or if there are too many authors
+'''
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            idle = not bucket or now-bucket[-1][0] > self.max_int
+            if not idle and len(self.buckets) <= self.capacity:
+                break
+            del self.buckets[key]
+
+class BlacklistMatcher:
+    ''' Match blacklisted words in a message with a single pass
+        Words are built into an Aho-Corasick automaton once
+        Included characters are skipped while the message is scanned
+        Excluded characters next to a word mark it as part of another word
+'''
+    def __init__(self, blacklist, characters):
+        included, excluded = characters
+        self.included = frozenset(included)
+        self.excluded = frozenset(excluded)
+        self.words = []
+        self.patterns = []
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for word in blacklist:
+            if any(c in self.included for c in word):
+                #Words containing included characters cannot skip them
+                self.patterns.append((word, *self.compile(word, characters)))
+            else:
+                self.insert(word.lower())
+        self.build()
+        self.longest = max([len(w) for w in self.words], default=1)
+
+    @staticmethod
+    def compile(word, characters):
+        ''' Compile the regular expressions used for a single word
+'''
+        included, excluded = characters
+        #Word separates by non-alphabetic characters
+        regex_match_true = re.compile(
+            fr"[{included}]*".join([re.escape(c) for c in word]),
+            re.IGNORECASE)
+        #Word stands alone in another word
+        regex_match_none = re.compile(
+            fr"([{excluded}]+{re.escape(word)})|"
+            fr"({re.escape(word)}[{excluded}]+)",
+            re.IGNORECASE)
+        return regex_match_true, regex_match_none
+
+    def insert(self, word):
+        ''' Add a word to the automaton trie
+'''
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = len(self.goto)-1
+            state = self.goto[state][char]
+        self.output[state].append(len(self.words))
+        self.words.append(word)
+
+    def build(self):
+        ''' Compute the failure links of the automaton trie
+'''
+        states = collections.deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, child in self.goto[state].items():
+                states.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+
+    def search(self, content):
+        ''' Return the first blacklisted word in the content
+            Return None if no blacklisted word is found
+'''
+        text = content.lower()
+        found, alone = [], set()
+        positions = collections.deque(maxlen=self.longest)
+        state = 0
+        for index, char in enumerate(text):
+            if char in self.included:
+                continue
+            positions.append(index)
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for word in self.output[state]:
+                length = len(self.words[word])
+                start = positions[-length]
+                found.append(word)
+                #Check if word is within another word
+                if index-start+1 != length:
+                    continue
+                before = text[start-1] if start else ''
+                after = text[index+1] if index+1 < len(text) else ''
+                if before in self.excluded or after in self.excluded:
+                    alone.add(word)
+        for word in found:
+            if word not in alone:
+                return self.words[word]
+        for word, regex_match_true, regex_match_none in self.patterns:
+            if regex_match_true.search(content)\
+               and regex_match_none.search(content) is None:
+                return word
+        return None
 
 class Moderation(commands.Cog):
     ''' Parse messages with various features to moderate a text channel
 '''
     def __init__(self, bot):
         self.bot = bot
-        with open(os.path.join('data', 'moderation.txt')) as file:
-            self.data = json.load(file)
+        self.bot.config.load(
+            "moderation", self.compile_config, self.reload_config)
+        #Guilds with the same spam limits share a tracker
+        self.trackers = {}
+
+    @property
+    def data(self):
+        return self.bot.config["moderation"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("moderation", guild_id)
+
+    @staticmethod
+    def compile_config(data):
+        ''' Build the blacklist matcher and the command restriction sets
+'''
+        max_num, max_int = data["spam"]
+        if max_num < 1 or max_int <= 0:
+            raise ValueError("spam limits must be positive")
+        return {
+            "actives": {
+                k: bool(data["actives"][k])
+                for k in ("commands", "spam", "censor")},
+            "spam": (int(max_num), max_int),
+            "commands": {
+                name: {
+                    "channels": frozenset(parameters["channels"]),
+                    "roles": frozenset(parameters["roles"])}
+                for name, parameters in data["commands"].items()},
+            "matcher": BlacklistMatcher(
+                data["blacklist"], data["characters"])}
+
+    def reload_config(self, old, new):
+        ''' Stop tracking messages with the old limits if they changed
+'''
+        if old["spam"] != new["spam"]:
+            self.trackers.pop(old["spam"], None)
 
     async def commands(self, ctx):
         ''' Flag command used by members inproperly
@@ -504,7 +2519,8 @@ class Moderation(commands.Cog):
             - Commands used without necessary roles
 '''
         #Get information
-        parameters = self.data["commands"].get(ctx.command.name)
+        data = self.guild_data(ctx.guild.id)
+        parameters = data["commands"].get(ctx.command.name)
         if parameters is None:
             return False
         restricted = False
@@ -514,16 +2530,17 @@ class Moderation(commands.Cog):
             restricted = True
         #Verify member using command has necessary roles
         roles = parameters['roles']
-        if roles and not any(r.id in roles for r in ctx.author.roles):
+        if roles and roles.isdisjoint(r.id for r in ctx.author.roles):
             restricted = True
         if not restricted:
             return False
-        channel_names = [
-            discord.utils.get(ctx.guild.channels, id=c).name\
-            for c in channels]
-        role_names = [
-            discord.utils.get(ctx.guild.roles, id=r).name\
-            for r in roles]
+        log_event(
+            "moderation", action="command", guild=ctx.guild.id,
+            channel=ctx.channel.id, message=ctx.message.id,
+            author=ctx.author.id, command=ctx.command.name)
+        channel_names = self.bot.resolver.display(
+            ctx.guild, "channel", channels)
+        role_names = self.bot.resolver.display(ctx.guild, "role", roles)
         embed = discord.Embed(
             title="Command Used Improperly", color=0x00ff00)
         fields = {
@@ -537,30 +2554,29 @@ class Moderation(commands.Cog):
         await ctx.send(embed=embed)
         return True
 
+    @timed("Moderation.spam")
     async def spam(self, message):
         ''' Flag member if they send too many messages too quickly
+            Messages are tracked in memory as they are received
 '''
-        #Get parameters and initial conditions
-        max_num, max_int = self.data["spam"]
-        spam = False
-        tracked_messages = []
-        start_time = message.created_at
-        #Check time interval and message quantity
-        async for msg in message.channel.history(limit=50):
-            interval = (start_time-msg.created_at).total_seconds()
-            #Ignore messages sent after initial message
-            if interval <= 0:
-                continue
-            #Stop message count once interval exceeds specification
-            if interval > max_int:
-                break
-            #Flag as spam if tracked messages exceeds specification
-            if len(tracked_messages) >= max_num:
-                spam = True
-            tracked_messages.append(msg)
-        if not spam:
+        #Get parameters and tracked messages
+        limits = self.guild_data(getattr(message.guild, 'id', None))["spam"]
+        max_num, max_int = limits
+        tracker = self.trackers.get(limits)
+        if tracker is None:
+            tracker = self.trackers[limits] = SpamTracker(*limits)
+        tracked_messages = tracker.track(message)
+        if not tracked_messages:
             return False
-        await message.channel.delete_messages(tracked_messages)
+        log_event(
+            "moderation", action="spam",
+            guild=getattr(message.guild, 'id', None),
+            channel=message.channel.id, author=message.author.id,
+            messages=tracked_messages)
+        #Current message is deleted once it is flagged
+        await message.channel.delete_messages([
+            discord.Object(id=i) for i in tracked_messages
+            if i != message.id])
         #Flag member for spam
         embed = discord.Embed(
             title="Member Marked for Spam", color=0x00ff00)
@@ -574,29 +2590,21 @@ class Moderation(commands.Cog):
         await message.channel.send(embed=embed)
         return True
 
+    @timed("Moderation.censor")
     async def censor(self, message):
         ''' Flag message if it contains any of the blacklisted words
             Words will be flagged if non-alphabetic characters separate word
             Words will not be flagged if word stands alone in another word
 '''
-        #Get parameters
-        blacklist = self.data["blacklist"]
-        included, excluded = self.data["characters"]
-        #Check if any blacklisted word in message
-        profane = False
-        for word in blacklist:
-            #Word separates by non-alphabetic characters
-            regex_match_true = re.compile(
-                fr"[{included}]*".join(list(word)), re.IGNORECASE)
-            #Word stands alone in another word
-            regex_match_none = re.compile(
-                fr"([{excluded}]+{word})|({word}[{excluded}]+)",re.IGNORECASE)
-            if regex_match_true.search(message.content)\
-               and regex_match_none.search(message.content) is None:
-                profane = True
-                break
-        if not profane:
+        data = self.guild_data(getattr(message.guild, 'id', None))
+        word = data["matcher"].search(message.content)
+        if word is None:
             return False
+        log_event(
+            "moderation", action="censor",
+            guild=getattr(message.guild, 'id', None),
+            channel=message.channel.id, message=message.id,
+            author=message.author.id, word=word)
         #Flag message for profanity
         embed = discord.Embed(
             title="Blacklisted Word Detected in Message :no_entry_sign:",
@@ -607,52 +2615,273 @@ class Moderation(commands.Cog):
         await message.channel.send(embed=embed)
         return True
 
+class ReactionState:
+    ''' Track the reactions of members on reaction role panels
+        Reactions are kept in memory so panels do not need to be fetched
+'''
+    def __init__(self):
+        self.reactions = {}
+
+    def add(self, message_id, member_id, emoji):
+        ''' Record that a member reacted to a panel
+            Unicode emojis of fetched reactions are given as strings
+'''
+        self.reactions.setdefault(message_id, {}).setdefault(
+            member_id, {})[getattr(emoji, 'name', emoji)] = emoji
+
+    def remove(self, message_id, member_id, name):
+        ''' Record that a member removed a reaction from a panel
+            Return if the reaction was recorded
+'''
+        members = self.reactions.get(message_id, {})
+        reacted = members.get(member_id, {})
+        if reacted.pop(name, None) is None:
+            return False
+        if not reacted:
+            del members[member_id]
+        if not members:
+            del self.reactions[message_id]
+        return True
+
+    def get(self, message_id, member_id):
+        ''' Get the reactions of a member on a panel keyed by emoji name
+'''
+        return self.reactions.get(message_id, {}).get(member_id, {})
+
+    def resolve(self, emojis, message_id, member_id, choice=None):
+        ''' Get the role IDs a member should and should not have
+            A new choice replaces the other reactions of the member, which
+            are returned so they can be removed from the panel
+'''
+        reacted = self.get(message_id, member_id)
+        extra = []
+        if choice in reacted:
+            names = [n for n in reacted if n != choice]
+            extra = [reacted[n] for n in names]
+            for name in names:
+                self.remove(message_id, member_id, name)
+        add = {r for n in self.get(message_id, member_id)
+               for r in emojis.get(n, ())}
+        remove = {r for roles in emojis.values() for r in roles}-add
+        return add, remove, extra
+
 class ReactionRoles(commands.Cog):
     ''' Grant member role when they react to message
+        Reactions of a member are debounced and applied as one role edit
+        Reactions added while the bot was offline are reconciled at startup
 '''
-    def __init__(self, bot):
+    def __init__(self, bot, *, delay=1, concurrency=4, batch=50):
         self.bot = bot
-        with open(os.path.join('data', 'reaction_roles.txt')) as file:
-            self.messages = {int(k):v for k, v in json.load(file).items()}
+        self.bot.config.load("reaction_roles", self.compile_config)
+        self.delay = delay
+        self.concurrency = concurrency
+        self.batch = batch
+        self.state = ReactionState()
+        self.pending = {}
+        self.reconcile_task = None
+
+    @property
+    def messages(self):
+        return self.bot.config["reaction_roles"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("reaction_roles", guild_id)
+
+    @staticmethod
+    def compile_config(data):
+        ''' Key the messages by ID and convert the role IDs
+'''
+        return {
+            int(k): {
+                emoji: tuple(int(r) for r in roles)
+                for emoji, roles in emojis.items()}
+            for k, emojis in data.items()}
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.reconcile_task is None or self.reconcile_task.done():
+            self.reconcile_task = self.bot.loop.create_task(self.reconcile())
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
         if payload.member.bot:
             return
-        if payload.message_id not in self.messages:
+        if payload.message_id not in self.guild_data(payload.guild_id):
             return
-        await self.manage_rroles(payload, mode='+')
+        self.state.add(payload.message_id, payload.user_id, payload.emoji)
+        self.debounce(payload, choice=payload.emoji.name)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
-        if payload.message_id not in self.messages:
+        if payload.message_id not in self.guild_data(payload.guild_id):
             return
-        await self.manage_rroles(payload, mode='-')
+        #Reactions removed by the bot were already removed from the state
+        if not self.state.remove(
+                payload.message_id, payload.user_id, payload.emoji.name):
+            return
+        self.debounce(payload)
 
-    async def manage_rroles(self, payload, *, mode):
-        ''' Add/Remove role(s) if the member added/removed a reaction
+    def debounce(self, payload, *, choice=None):
+        ''' Delay managing the roles of a member until they stop reacting
 '''
-        #Get informatino from paylaod
-        guild = self.bot.get_guild(payload.guild_id)
-        channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        member = guild.get_member(payload.user_id)
-        data = self.messages.get(payload.message_id)
-        #Manage all roles according to the emoji used
-        for roleid in data[payload.emoji.name]:
-            #Get role from emoji
-            role = discord.utils.get(
-                guild.roles, id=int(roleid))
-            if mode == '+':
-                await member.add_roles(role)
-                #Remove all other reactions used by member
-                for rxn in message.reactions:
-                    if rxn.emoji.name == payload.emoji.name:
-                        continue
-                    await message.remove_reaction(
-                        rxn, member)
-            elif mode == '-':
-                await member.remove_roles(role)
+        key = (payload.message_id, payload.user_id)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = {
+                "guild": payload.guild_id, "channel": payload.channel_id,
+                "choice": None, "handle": None}
+        else:
+            pending["handle"].cancel()
+        if choice is not None:
+            pending["choice"] = choice
+        pending["handle"] = asyncio.get_event_loop().call_later(
+            self.delay,
+            lambda: asyncio.ensure_future(self.manage_rroles(*key)))
+
+    @timed("ReactionRoles.manage_rroles")
+    async def manage_rroles(self, message_id, member_id):
+        ''' Give a member the roles of their reactions on a panel
+'''
+        #A reaction between the delay firing and this call reschedules the
+        #same entry, which an earlier call has then already handled
+        pending = self.pending.pop((message_id, member_id), None)
+        if pending is None:
+            return
+        guild = self.bot.get_guild(pending["guild"])
+        member = self.bot.resolver.member(guild, member_id)
+        data = self.guild_data(pending["guild"]).get(message_id)
+        if member is None or data is None:
+            return
+        add, remove, extra = self.state.resolve(
+            data, message_id, member_id, pending["choice"])
+        roles = {
+            i: self.bot.resolver.role(guild, i) for i in add | remove}
+        self.bot.actions.edit_roles(
+            member, add=[roles[i] for i in add if roles[i] is not None],
+            remove=[roles[i] for i in remove if roles[i] is not None])
+        channel = self.bot.get_channel(pending["channel"])
+        message = channel.get_partial_message(message_id)
+        #Remember the channel of the panel for startup reconciliation
+        panel = self.bot.panels.get(message_id, "ReactionRoles")
+        if panel is None or panel["kind"] == "missing":
+            self.bot.panels.register(
+                message, "ReactionRoles", "panel", cursors={})
+        #Remove all other reactions used by member
+        for emoji in extra:
+            self.bot.actions.remove_reaction(message, emoji, member)
+
+    async def reconcile(self):
+        ''' Reconcile each reaction role panel in the guild which owns it
+'''
+        semaphore = asyncio.Semaphore(self.concurrency)
+        for message_id in self.messages:
+            try:
+                message = await self.locate(message_id, semaphore)
+                if message is None:
+                    continue
+                emojis = self.guild_data(message.guild.id).get(message_id)
+                if emojis is not None:
+                    await self.reconcile_panel(
+                        message.guild, message, emojis, semaphore)
+            except discord.HTTPException as error:
+                logging.warning(
+                    "Reaction Role Reconciliation Failed: %s: %s",
+                    message_id, error)
+
+    async def locate(self, message_id, semaphore):
+        ''' Fetch a panel from the channel it was registered in
+            Unregistered panels are searched for once in the text channels
+            of the guilds which were not searched before
+'''
+        panel = self.bot.panels.get(message_id, "ReactionRoles")
+        if panel is not None and panel["kind"] == "panel":
+            guild = self.bot.get_guild(panel["guild"])
+            channel = self.bot.resolver.channel(guild, panel["channel"])
+            if channel is None:
+                return None
+            async with semaphore:
+                return await channel.fetch_message(message_id)
+        searched = set() if panel is None else set(panel["state"]["guilds"])
+        for guild in self.bot.guilds:
+            if guild.id in searched\
+               or message_id not in self.guild_data(guild.id):
+                continue
+            searched.add(guild.id)
+            for channel in guild.text_channels:
+                try:
+                    async with semaphore:
+                        message = await channel.fetch_message(message_id)
+                except (discord.NotFound, discord.Forbidden):
+                    continue
+                self.bot.panels.register(
+                    message, "ReactionRoles", "panel", cursors={})
+                return message
+        #Remember the guilds searched so they are not searched again
+        self.bot.panels.record(
+            message_id, None, None, "ReactionRoles", "missing",
+            guilds=sorted(searched))
+        logging.warning("Reaction Role Panel Not Found: %s", message_id)
+        return None
+
+    async def reconcile_panel(self, guild, message, emojis, semaphore):
+        ''' Give the members who reacted to a panel the roles they are missing
+            Roles are only added, since members may have been given the
+            roles of a panel without reacting to it
+            The reactors paged so far are saved so an interrupted pass can
+            resume
+'''
+        message_id = message.id
+        cursors = self.bot.panels.get(
+            message_id, "ReactionRoles")["state"]["cursors"]
+        await asyncio.gather(*[
+            self.page_reactions(message, r, cursors, semaphore)
+            for r in message.reactions
+            if getattr(r.emoji, 'name', r.emoji) in emojis])
+        member_ids = list(self.state.reactions.get(message_id, {}))
+        changes = []
+        for member_id in member_ids:
+            member = self.bot.resolver.member(guild, member_id)
+            #Members who are reacting are handled by the live events
+            if member is None or (message_id, member_id) in self.pending:
+                continue
+            add, _, _ = self.state.resolve(emojis, message_id, member_id)
+            add = add-{r.id for r in member.roles}
+            add = [self.bot.resolver.role(guild, i) for i in add]
+            add = [r for r in add if r is not None]
+            if add:
+                changes.append((member, add))
+        for i in range(0, len(changes), self.batch):
+            await asyncio.gather(return_exceptions=True, *[
+                self.bot.actions.edit_roles(member, add=add)
+                for member, add in changes[i:i+self.batch]])
+            logging.info(
+                "Reconciling Reaction Roles: %s: %s/%s members", message_id,
+                min(i+self.batch, len(changes)), len(changes))
+        self.bot.panels.update(message_id, "panel", cursors={})
+        log_event(
+            "reaction_roles", action="reconcile", guild=guild.id,
+            message=message_id, members=len(member_ids),
+            changes=len(changes))
+
+    async def page_reactions(self, message, reaction, cursors, semaphore):
+        ''' Record the members who reacted with an emoji
+            The last member recorded is saved after each batch
+'''
+        name = getattr(reaction.emoji, 'name', reaction.emoji)
+        after = cursors.get(name)
+        if after is not None:
+            after = discord.Object(id=after)
+        count = 0
+        async with semaphore:
+            async for user in reaction.users(limit=None, after=after):
+                if user.bot:
+                    continue
+                self.state.add(message.id, user.id, reaction.emoji)
+                count += 1
+                if count % self.batch == 0:
+                    cursors[name] = user.id
+                    self.bot.panels.update(
+                        message.id, "panel", cursors=cursors)
 
 class VoiceChannelControl(commands.Cog):
     ''' Allow guild member to be able to claim control of a voice channel
@@ -661,33 +2890,61 @@ class VoiceChannelControl(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        with open(os.path.join('data', 'voice_channel_control.txt')) as file:
-            self.data = json.load(file)
+        self.bot.config.load("voice_channel_control", self.compile_config)
         self.emojis = [
             u'0\ufe0f\u20e3', u'1\ufe0f\u20e3', u'2\ufe0f\u20e3',
             u'3\ufe0f\u20e3', u'4\ufe0f\u20e3', u'5\ufe0f\u20e3',
             u'6\ufe0f\u20e3', u'7\ufe0f\u20e3', u'8\ufe0f\u20e3',
             u'9\ufe0f\u20e3']
-        self.claims = {}
-        self.claim_requests = {}
-        self.voice_channels = {}
+        #Claims and claim requests of each guild keyed by member
+        self.guilds = GuildCache(
+            self.load_guild, capacity=bot.data["guilds"]["capacity"])
+
+    @property
+    def data(self):
+        return self.bot.config["voice_channel_control"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("voice_channel_control", guild_id)
+
+    def load_guild(self, guild_id):
+        ''' Restore the claims of a guild from its active panels
+'''
+        state = {"claims": {}, "claim_requests": {}}
+        panels = self.bot.panels.find("VoiceChannelControl", guild=guild_id)
+        for msg_id, panel in panels:
+            member_id = panel["state"]["member"]
+            state["claim_requests"][member_id] = msg_id
+            if panel["kind"] == "control":
+                state["claims"][member_id] = panel["state"]["channel"]
+        return state
+
+    @staticmethod
+    def compile_config(data):
+        ''' Validate the category of the voice channels which are claimed
+'''
+        return {"category": int(data["category"])}
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
         ''' Listen for member using emojis to control other members' voices
 '''
-        logging.info("Raw Reaction Add: %s", payload)
-        if payload.member.bot:
+        panel = self.bot.panels.get(payload.message_id, "VoiceChannelControl")
+        if panel is None or payload.member.bot:
             return
-        channel = self.bot.get_channel(payload.channel_id)
-        message = await channel.fetch_message(payload.message_id)
-        embed = message.embeds[0]
-        if embed.footer.text != "VoiceChannelControl":
+        log_event(
+            "raw_reaction_add", guild=payload.guild_id,
+            channel=payload.channel_id, message=payload.message_id,
+            member=payload.user_id, emoji=str(payload.emoji))
+        #Only the member who requested the panel can use it
+        if panel["state"]["member"] != payload.member.id:
             return
-        if payload.emoji.name in self.emojis:
-            await self.claim_control_panel(payload)
+        if panel["kind"] == "claim" and payload.emoji.name in self.emojis:
+            await self.claim_control_panel(payload, panel)
         elif payload.emoji.name == u'\u274c':
             await self.cancel_claim(payload)
+        elif panel["kind"] != "control":
+            return
         elif payload.emoji.name in ["\U0001f507", "\U0001f508"]:
             await self.voice_control(payload)
         elif payload.emoji.name == "\U0001f3f3":
@@ -701,10 +2958,11 @@ class VoiceChannelControl(commands.Cog):
 '''
         if await self.bot.check_commands(ctx):
             return
-        if ctx.author.id in self.claim_requests:
+        state = self.guilds[ctx.guild.id]
+        if ctx.author.id in state["claim_requests"]:
             await ctx.send("You already have an active claim request")
             return
-        if ctx.author.id in self.claims:
+        if ctx.author.id in state["claims"]:
             await ctx.send("You already have a voice channel claim")
             return
         await self.claim_request_panel(ctx)
@@ -714,62 +2972,64 @@ class VoiceChannelControl(commands.Cog):
         ''' Send an embed with reactions for member to claim a voice channel
 '''
         #Get voice channels in category
-        self.voice_channels = discord.utils.get(
-            ctx.guild.categories, id=self.data['category']).channels
+        category = self.bot.resolver.channel(
+            ctx.guild, self.guild_data(ctx.guild.id)['category'])
+        if category is None:
+            return
+        voice_channels = category.channels
         #Send claim request panel
         embed = discord.Embed(
             title="Voice Channel Claim", color=0x00ff00)
         fields = {
             "Channel Options": '\n'.join([
-                f"{self.emojis[self.voice_channels.index(c)]} - {c}"\
-                for c in self.voice_channels]),
+                f"{self.emojis[voice_channels.index(c)]} - {c}"\
+                for c in voice_channels]),
             "Claim": "Use the reactions below to claim a lobby",
             "Cancel": "React with :x: to cancel"}
         for field in fields:
             embed.add_field(name=field, value=fields[field])
         embed.set_footer(text="VoiceChannelControl")
         panel = await ctx.channel.send(embed=embed)
-        self.claim_requests.setdefault(ctx.message.author.id, panel.id)
+        self.guilds[ctx.guild.id]["claim_requests"].setdefault(
+            ctx.author.id, panel.id)
+        self.bot.panels.register(
+            panel, "VoiceChannelControl", "claim", member=ctx.author.id,
+            channels=[c.id for c in voice_channels])
         #Add reactions to claim request panel
-        for channel in self.voice_channels:
-            await panel.add_reaction(
-                self.emojis[self.voice_channels.index(channel)])
-        await panel.add_reaction(u'\u274c')
+        self.bot.actions.add_reactions(
+            panel, self.emojis[:len(voice_channels)]+[u'\u274c'])
 
     async def cancel_claim(self, payload):
         ''' Cancel the request to claim a voice channel
 '''
         #Get channel and message information from payload
-        msg_id = self.claim_requests.get(payload.member.id)
-        channel = discord.utils.get(
-            payload.member.guild.channels, id=payload.channel_id)
-        if msg_id is None:
-            await channel.send(
-                "You do not have an active voice channel claim")
-            return
-        panel = await channel.fetch_message(msg_id)
+        channel = self.bot.get_channel(payload.channel_id)
+        panel = channel.get_partial_message(payload.message_id)
         #Deprecate voice channel claim panel
-        await panel.clear_reactions()
+        self.bot.actions.clear_reactions(panel)
         embed = discord.Embed(
             title="Voice Channel Claim Canceled", color=0x00ff00)
         await panel.edit(embed=embed)
-        del self.claim_requests[payload.member.id]
-        await asyncio.sleep(10)
-        await panel.delete()
+        self.bot.panels.remove(panel.id)
+        state = self.guilds[payload.guild_id]
+        state["claim_requests"].pop(payload.member.id, None)
+        state["claims"].pop(payload.member.id, None)
+        self.bot.timers.delete_later(panel, 10)
 
-    async def claim_control_panel(self, payload):
+    async def claim_control_panel(self, payload, request):
         ''' Send an embed with reactions for member to manage members' voices
 '''
         #Get voice channel and message from payload
-        voice_channel = discord.utils.get(
-            self.voice_channels,
-            name=self.voice_channels[
-                self.emojis.index(payload.emoji.name)
-                ].name)
+        index = self.emojis.index(payload.emoji.name)
+        if index >= len(request["state"]["channels"]):
+            return
+        voice_channel = self.bot.get_channel(
+            request["state"]["channels"][index])
         channel = self.bot.get_channel(payload.channel_id)
-        panel = await channel.fetch_message(
-            self.claim_requests.get(payload.member.id))
-        self.claims.setdefault(payload.member.id, voice_channel.id)
+        panel = channel.get_partial_message(payload.message_id)
+        self.guilds[payload.guild_id]["claims"].setdefault(
+            payload.member.id, voice_channel.id)
+        self.bot.panels.update(panel.id, "control", channel=voice_channel.id)
         #Edit panel for voice channel control
         embed = discord.Embed(
             title="Voice Channel Control Panel", color=0x00ff00)
@@ -783,40 +3043,46 @@ class VoiceChannelControl(commands.Cog):
         embed.set_footer(text="VoiceChannelControl")
         await panel.edit(embed=embed)
         #Add voice control reactions
-        await panel.clear_reactions()
+        self.bot.actions.clear_reactions(panel)
         reactions = ["\U0001f507", "\U0001f508", "\U0001f3f3"]
-        for reaction in reactions:
-            await panel.add_reaction(reaction)
+        self.bot.actions.add_reactions(panel, reactions)
 
     async def voice_control(self, payload):
         ''' Manage members' voices according to the reaction used
 '''
         channel = self.bot.get_channel(payload.channel_id)
-        panel = await channel.fetch_message(
-            self.claim_requests.get(payload.member.id))
+        panel = channel.get_partial_message(payload.message_id)
         #Manage the voices of the members based on the emoji used
         controls = {"\U0001f507": True, "\U0001f508": False}
         voice_channel = self.bot.get_channel(
-            self.claims.get(payload.member.id))
+            self.guilds[payload.guild_id]["claims"].get(payload.member.id))
         if not voice_channel.members:
             message = await channel.send(
                 f"There are no members in {voice_channel.name}")
-            await asyncio.sleep(5)
-            await message.delete()
+            self.bot.timers.delete_later(message, 5)
         else:
-            for member in voice_channel.members:
-                await member.edit(mute=controls[payload.emoji.name])
-        await panel.remove_reaction(payload.emoji, payload.member)
+            start = time.perf_counter()
+            await self.bot.actions.edit_voices(
+                voice_channel.members, mute=controls[payload.emoji.name])
+            elapsed = time.perf_counter()-start
+            if self.bot.metrics.active:
+                self.bot.metrics.observe(
+                    "VoiceChannelControl.mute_fanout", elapsed)
+            log_event(
+                "voice_control", action="mute", guild=payload.guild_id,
+                channel=voice_channel.id, member=payload.member.id,
+                mute=controls[payload.emoji.name],
+                members=len(voice_channel.members), seconds=elapsed)
+        self.bot.actions.remove_reaction(panel, payload.emoji, payload.member)
 
     async def yield_control(self, payload):
         ''' Yield control of a claimed voice channel
 '''
         channel = self.bot.get_channel(payload.channel_id)
-        panel = await channel.fetch_message(
-            self.claim_requests.get(payload.member.id))
+        panel = channel.get_partial_message(payload.message_id)
         #Close control panel
         voice_channel = self.bot.get_channel(
-            self.claims.get(payload.member.id))
+            self.guilds[payload.guild_id]["claims"].get(payload.member.id))
         embed = discord.Embed(
             title="Voice Channel Control Panel Closed", color=0x00ff00)
         fields = {
@@ -825,20 +3091,21 @@ class VoiceChannelControl(commands.Cog):
         for field in fields:
             embed.add_field(name=field, value=fields[field])
         await panel.edit(embed=embed)
-        await panel.clear_reactions()
-        del self.claim_requests[payload.member.id]
-        del self.claims[payload.member.id]
-        await asyncio.sleep(10)
-        await panel.delete()
+        self.bot.actions.clear_reactions(panel)
+        self.bot.panels.remove(panel.id)
+        state = self.guilds[payload.guild_id]
+        del state["claim_requests"][payload.member.id]
+        del state["claims"][payload.member.id]
+        self.bot.timers.delete_later(panel, 10)
 
     async def disconnect_with_claim(self, member):
         ''' Send message to member if they disconnect while holding a claim
 '''
-        if member.id not in self.claims:
+        claims = self.guilds[member.guild.id]["claims"]
+        if member.id not in claims:
             return
-        voice_channel = self.claims.get(member.id)
+        voice_channel = self.bot.get_channel(claims.get(member.id))
         #Notify member that they still have a claim and request that they yield it
-        direct_message = await member.create_dm()
         embed = discord.Embed(
             title="Disconnected from Voice Channel with Claim", color=0x00ff00)
         fields = {
@@ -849,17 +3116,18 @@ class VoiceChannelControl(commands.Cog):
             "Yield Claim": "React with :flag_white:"}
         for field in fields:
             embed.add_field(name=field, value=fields[field])
-        await direct_message.send(embed=embed)
+        self.bot.notifier.notify(member, embed)
 
     async def manage_new_voice_channel_join(self, new_member, channel):
         #Parse guild roles to check if the voice channel is claimed
-        role = discord.utils.get(
-            channel.guild.roles, name=f"_Claimed: {channel.name}_")
+        role = self.bot.resolver.find(
+            channel.guild, "role", f"_Claimed: {channel.name}_")
         if role is None:
             return
         #Edit new member voice
+        claim_requests = self.guilds[channel.guild.id]["claim_requests"]
         for member in channel.members:
-            if member.id in self.claim_requests:
+            if member.id in claim_requests:
                 await new_member.edit(mute=member.voice.mute)
 
 class WelcomeMessage(commands.Cog):
@@ -867,8 +3135,28 @@ class WelcomeMessage(commands.Cog):
 '''
     def __init__(self, bot):
         self.bot = bot
-        with open(os.path.join('data', 'welcome_message.txt')) as file:
-            self.data = json.load(file)
+        self.bot.config.load("welcome_message", self.compile_config)
+
+    @property
+    def data(self):
+        return self.bot.config["welcome_message"]
+
+    def guild_data(self, guild_id):
+        return self.bot.config.guild("welcome_message", guild_id)
+
+    @staticmethod
+    def compile_config(data):
+        ''' Validate the private and public welcome messages
+'''
+        config = {}
+        for kind in ("private", "public"):
+            message = data[kind]
+            config[kind] = {
+                "active": bool(message["active"]),
+                "title": str(message["title"]),
+                "fields": dict(message["fields"])}
+        config["public"]["channel"] = int(data["public"]["channel"])
+        return config
 
     @commands.Cog.listener()
     async def on_member_join(self, member):
@@ -880,43 +3168,100 @@ class WelcomeMessage(commands.Cog):
     async def private_message(self, member):
         ''' Send private message embed in direct message channel
 '''
-        if not self.data["private"]["active"]:
+        data = self.guild_data(member.guild.id)["private"]
+        if not data["active"]:
             return
-        direct_message = await member.create_dm()
-        embed = discord.Embed(
-            title=self.data["private"]["title"],
-            color=0xff0000)
-        fields = self.data["private"]["fields"]
+        embed = discord.Embed(title=data["title"], color=0xff0000)
+        fields = data["fields"]
         for field in fields:
             embed.add_field(name=field, value=fields[field])
-        await direct_message.send(embed=embed)
+        self.bot.notifier.notify(member, embed)
 
     async def public_message(self, member):
         ''' Send public message embed in determined channel
 '''
-        if not self.data["public"]["active"]:
+        data = self.guild_data(member.guild.id)["public"]
+        if not data["active"]:
             return
-        channel = discord.utils.get(
-            member.guild.channels, id=self.data["public"]["channel"])
-        embed = discord.Embed(
-            title=self.data["public"]["title"],
-            color=0xff0000)
-        fields = self.data["public"]["fields"]
+        channel = self.bot.resolver.channel(member.guild, data["channel"])
+        if channel is None:
+            return
+        embed = discord.Embed(title=data["title"], color=0xff0000)
+        fields = data["fields"]
         for field in fields:
             embed.add_field(name=field, value=fields[field])
         await channel.send(embed=embed)
         
+def run(token, *, sharded=False, **options):
+    ''' Run the bot with the shards given in the options
+'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot_class = ShardedUtils if sharded else Utils
+    discord_bot = bot_class(
+        prefix="*", name="Util5", loop=loop, **options)
+    loop.create_task(discord_bot.start(token))
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(discord_bot.close())
+
+def shard_recording(path, shard_ids):
+    ''' Get the recording file name of a process from its shard range
+'''
+    if path is None:
+        return None
+    root, ext = os.path.splitext(path)
+    if ext == '.gz':
+        root, inner = os.path.splitext(root)
+        ext = inner + ext
+    return f"{root}-{shard_ids[0]}-{shard_ids[-1]}{ext}"
+
 def main():
+    parser = argparse.ArgumentParser(description="Run the Utils bot")
+    parser.add_argument(
+        "--sharded", action="store_true",
+        help="run with AutoShardedBot and the recommended shard count")
+    parser.add_argument(
+        "--shards", type=int, help="total number of shards of the bot")
+    parser.add_argument(
+        "--shard-range", type=int, nargs=2, metavar=("FIRST", "LAST"),
+        help="run only the shards from FIRST to LAST inclusive")
+    parser.add_argument(
+        "--processes", type=int, default=1,
+        help="number of processes to split the shards between")
+    parser.add_argument(
+        "--record", metavar="PATH",
+        help="record gateway events to a gzipped JSON lines file; "
+             "each process adds its shard range to the file name")
+    args = parser.parse_args()
     token = os.environ.get("token", None)
     if token is None:
         with open('token.txt') as file:
             token = file.read()
     assert token is not None
-    loop = asyncio.get_event_loop()
-    discord_bot = Utils(
-        prefix="*", name="Util5")
-    loop.create_task(discord_bot.start(token))
-    loop.run_forever()
+    if args.shards is None:
+        run(token, sharded=args.sharded, recording=args.record)
+        return
+    first, last = args.shard_range or (0, args.shards-1)
+    shard_ids = list(range(first, last+1))
+    #Split the shards into contiguous ranges, one for each process
+    ranges = [
+        shard_ids[i*len(shard_ids)//args.processes:
+                  (i+1)*len(shard_ids)//args.processes]
+        for i in range(args.processes)]
+    #Each process serves its metrics on the base port plus its index
+    processes = [
+        multiprocessing.Process(
+            target=run, args=(token,), kwargs={
+                "sharded": True, "shard_ids": r,
+                "shard_count": args.shards, "process": i,
+                "recording": shard_recording(args.record, r)})
+        for i, r in enumerate([r for r in ranges if r])]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
 
 if __name__ == '__main__':
     main()
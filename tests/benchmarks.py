@@ -0,0 +1,533 @@
+#! python3
+# benchmarks.py
+
+import argparse
+import asyncio
+import collections
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import sys
+import time
+import timeit
+import types
+
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+import discord
+
+SNOWFLAKES = itertools.count(800000000000000000)
+
+def open_file(name):
+    with open(os.path.join('data', name)) as file:
+        return json.load(file)
+
+def censor_loop(blacklist, characters, content):
+    ''' Check content with the per-word regular expressions
+'''
+    included, excluded = characters
+    for word in blacklist:
+        regex_match_true = re.compile(
+            fr"[{included}]*".join(list(word)), re.IGNORECASE)
+        regex_match_none = re.compile(
+            fr"([{excluded}]+{word})|({word}[{excluded}]+)",re.IGNORECASE)
+        if regex_match_true.search(content)\
+           and regex_match_none.search(content) is None:
+            return True
+    return False
+
+def benchmark_censor(number=5):
+    ''' Compare the blacklist matcher with the per-word loop
+'''
+    data = open_file('moderation.txt')
+    blacklist, characters = data["blacklist"], data["characters"]
+    matcher = bot.BlacklistMatcher(blacklist, characters)
+    messages = [
+        "gg everyone, that was a close one",
+        "who was in electrical when the lights went out?",
+        "I saw red vent in admin, vote them out " * 5,
+        "that's a b.a.s.t.a.r.d move",
+        "the passage through the classroom"]
+    for content in messages:
+        assert censor_loop(blacklist, characters, content)\
+               == (matcher.search(content) is not None), content
+    print(f"Censor ({len(blacklist)} words, {len(messages)} messages)")
+    results = {
+        "Per-word loop": lambda: [
+            censor_loop(blacklist, characters, m) for m in messages],
+        "Blacklist matcher": lambda: [
+            matcher.search(m) for m in messages]}
+    for name, function in results.items():
+        seconds = timeit.timeit(function, number=number)
+        per_message = seconds/(number*len(messages))*1e6
+        print(f"    {name}: {per_message:.1f} us/message")
+
+class RestStub:
+    ''' Record REST calls made by the fake objects and simulate latency
+'''
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+
+    async def request(self, route):
+        self.calls[route] += 1
+        await asyncio.sleep(self.latency)
+
+class FakeObject:
+    ''' Hashable fake with an ID
+        discord.Object is not used since its created_at is read-only
+'''
+    def __init__(self, *, id):
+        self.id = id
+
+    def __eq__(self, other):
+        return isinstance(other, FakeObject) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeEmoji:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+class FakeRole(FakeObject):
+    def __init__(self, guild, *, id=None, name=None):
+        super().__init__(id=next(SNOWFLAKES) if id is None else id)
+        self.guild = guild
+        self.name = f"Role {self.id}" if name is None else name
+        self.color = 0x00ff00
+
+    async def delete(self):
+        await self.guild.rest.request("DELETE /guilds/{guild_id}/roles")
+        self.guild.roles.remove(self)
+
+class FakeMember(FakeObject):
+    def __init__(self, guild, *, bot=False):
+        super().__init__(id=next(SNOWFLAKES))
+        self.guild = guild
+        self.bot = bot
+        self.name = f"Member {self.id}"
+        self.mention = f"<@{self.id}>"
+        self.roles = [guild.default_role]
+        self.voice = types.SimpleNamespace(mute=False)
+        self.dm_channel = None
+
+    async def edit(self, *, roles=None, mute=None):
+        await self.guild.rest.request(
+            "PATCH /guilds/{guild_id}/members/{user_id}")
+        if roles is not None:
+            self.roles = [self.guild.default_role]+list(roles)
+        if mute is not None:
+            self.voice.mute = mute
+
+    async def add_roles(self, *roles):
+        for role in roles:
+            await self.guild.rest.request(
+                "PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}")
+            self.roles.append(role)
+
+    async def remove_roles(self, *roles):
+        for role in roles:
+            await self.guild.rest.request(
+                "DELETE /guilds/{guild_id}/members/{user_id}/roles/{role_id}")
+            self.roles.remove(role)
+
+    async def create_dm(self):
+        await self.guild.rest.request("POST /users/@me/channels")
+        if self.dm_channel is None:
+            self.dm_channel = FakeChannel(self.guild, name="dm", dm=True)
+        return self.dm_channel
+
+class FakeMessage(FakeObject):
+    def __init__(self, channel, author, content="", *, id=None):
+        super().__init__(id=next(SNOWFLAKES) if id is None else id)
+        self.channel = channel
+        self.guild = channel.guild
+        self._state = channel._state
+        self.author = author
+        self.content = content
+        self.created_at = datetime.datetime.utcnow()
+        self.mention_everyone = "@everyone" in content
+        self.raw_mentions = [
+            int(i) for i in re.findall(r"<@!?([0-9]+)>", content)]
+        self.raw_role_mentions = [
+            int(i) for i in re.findall(r"<@&([0-9]+)>", content)]
+        self.reactions = []
+        self.embeds = []
+        self.rest = channel.rest
+
+    async def delete(self):
+        await self.rest.request(
+            "DELETE /channels/{channel_id}/messages/{message_id}")
+
+    async def edit(self, **kwargs):
+        await self.rest.request(
+            "PATCH /channels/{channel_id}/messages/{message_id}")
+
+    async def add_reaction(self, emoji):
+        await self.rest.request(
+            "PUT /channels/{channel_id}/messages/{message_id}/reactions")
+        self.reactions.append(types.SimpleNamespace(emoji=FakeEmoji(emoji)))
+
+    async def remove_reaction(self, emoji, member):
+        await self.rest.request(
+            "DELETE /channels/{channel_id}/messages/{message_id}/reactions")
+
+    async def clear_reactions(self):
+        await self.rest.request(
+            "DELETE /channels/{channel_id}/messages/{message_id}/reactions")
+        self.reactions = []
+
+class FakeChannel(FakeObject):
+    def __init__(self, guild, *, name, dm=False):
+        super().__init__(id=next(SNOWFLAKES))
+        self.guild = None if dm else guild
+        self.name = name
+        self.members = []
+        self.messages = {}
+        self.rest = guild.rest
+        self._state = guild._state
+        self.me = guild.me
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.request("POST /channels/{channel_id}/messages")
+        message = FakeMessage(self, self.me, content or "")
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.rest.request(
+            "GET /channels/{channel_id}/messages/{message_id}")
+        return self.get_partial_message(message_id)
+
+    def get_partial_message(self, message_id):
+        if message_id not in self.messages:
+            self.messages[message_id] = FakeMessage(
+                self, self.me, id=message_id)
+        return self.messages[message_id]
+
+    async def delete_messages(self, messages):
+        await self.rest.request("POST /channels/{channel_id}/messages/bulk")
+
+class FakeGuild(FakeObject):
+    def __init__(self, rest, state, *, size):
+        super().__init__(id=next(SNOWFLAKES))
+        self.rest = rest
+        self._state = state
+        self.default_role = FakeRole(self, id=self.id, name="@everyone")
+        self.roles = [self.default_role]
+        self.channels = []
+        self.categories = []
+        self.members = []
+        self.me = FakeMember(self, bot=True)
+        for _ in range(size):
+            self.members.append(FakeMember(self))
+
+    def add_channel(self, name):
+        channel = FakeChannel(self, name=name)
+        self.channels.append(channel)
+        return channel
+
+    def add_role(self, *, id=None, name=None):
+        role = FakeRole(self, id=id, name=name)
+        self.roles.append(role)
+        return role
+
+    async def create_role(self, *, name):
+        await self.rest.request("POST /guilds/{guild_id}/roles")
+        return self.add_role(name=name)
+
+    def get_member(self, member_id):
+        return self.member_ids.get(member_id)
+
+    def get_role(self, role_id):
+        return discord.utils.get(self.roles, id=role_id)
+
+    def get_channel(self, channel_id):
+        return discord.utils.get(
+            self.channels+self.categories, id=channel_id)
+
+    @property
+    def member_ids(self):
+        return {m.id: m for m in self.members}
+
+def create_payload(message, member, emoji):
+    ''' Create a fake RawReactionActionEvent
+'''
+    return types.SimpleNamespace(
+        message_id=message.id, channel_id=message.channel.id,
+        guild_id=message.guild.id, user_id=member.id, member=member,
+        emoji=FakeEmoji(emoji))
+
+class Harness:
+    ''' Drive the bot with fake gateway events against a stub REST layer
+'''
+    def __init__(self, *, members, latency):
+        self.rest = RestStub(latency)
+        self.utils = bot.Utils(
+            prefix="*", name="Benchmark", database=':memory:',
+            loop=asyncio.get_event_loop())
+        logging.getLogger().setLevel(logging.WARNING)
+        #Record the listener errors instead of only logging them
+        self.errors = collections.Counter()
+        async def on_error(event_method, *args, **kwargs):
+            self.errors[f"{event_method}: {sys.exc_info()[1]!r}"] += 1
+        self.utils.on_error = on_error
+        self.guild = FakeGuild(self.rest, self.utils._connection, size=members)
+        self.general = self.guild.add_channel("general")
+        self.utils._connection.user = self.guild.me
+        channels = {c.id: c for c in self.guild.channels}
+        self.utils.get_channel = lambda i: channels.get(i)
+        self.utils.get_guild = lambda i: self.guild
+        #Create the roles and messages used by the reaction role panels
+        self.reaction_roles = []
+        rroles = bot.ReactionRoles.__name__
+        for msg_id, emojis in self.utils.get_cog(rroles).messages.items():
+            message = self.general.get_partial_message(msg_id)
+            for emoji, role_ids in emojis.items():
+                for role_id in role_ids:
+                    if self.guild.get_role(role_id) is None:
+                        self.guild.add_role(id=role_id)
+                message.reactions.append(
+                    types.SimpleNamespace(emoji=FakeEmoji(emoji)))
+                self.reaction_roles.append((message, emoji))
+        #Create a voice channel with a claimed control panel
+        self.voice = self.guild.add_channel("Lobby")
+        self.voice.members = self.guild.members[:10]
+        channels[self.voice.id] = self.voice
+        self.panel = self.general.get_partial_message(next(SNOWFLAKES))
+        self.host = self.guild.members[0]
+        self.utils.panels.register(
+            self.panel, "VoiceChannelControl", "control",
+            member=self.host.id, channel=self.voice.id)
+        vcc = self.utils.get_cog("VoiceChannelControl")
+        vcc.guilds[self.guild.id]["claims"][self.host.id] = self.voice.id
+        #Create a bounty panel
+        self.bounty = self.general.get_partial_message(next(SNOWFLAKES))
+        self.utils.panels.register(
+            self.bounty, "GuildPoints", "bounty", end=time.time()+3600)
+        ledger = self.utils.get_cog("GuildPoints").ledger
+        for member in self.guild.members:
+            ledger.set(member, "tickets", 1000)
+
+    def create_event(self, scenario):
+        ''' Create the name and arguments of an event for a scenario
+'''
+        member = random.choice(self.guild.members)
+        if scenario == "message":
+            content = random.choice([
+                "gg", "where?", "I saw red vent in electrical",
+                "what a b a s t a r d", "vote blue"])
+            return "message", (FakeMessage(self.general, member, content),)
+        if scenario == "message_delete":
+            mentioned = random.sample(self.guild.members, 3)
+            content = ' '.join([m.mention for m in mentioned])
+            message = FakeMessage(self.general, member, content)
+            #The message was cached by GhostPing when it was sent
+            self.utils.get_cog("GhostPing").mentions.add(message)
+            return "raw_message_delete", (types.SimpleNamespace(
+                message_id=message.id, channel_id=self.general.id,
+                guild_id=self.guild.id, cached_message=None),)
+        if scenario == "reaction_roles":
+            message, emoji = random.choice(self.reaction_roles)
+            return "raw_reaction_add", (
+                create_payload(message, member, emoji),)
+        if scenario == "guild_points":
+            emoji = random.choice(["1\ufe0f\u20e3", "\u274c"])
+            return "raw_reaction_add", (
+                create_payload(self.bounty, member, emoji),)
+        if scenario == "voice_control":
+            emoji = random.choice(["\U0001f507", "\U0001f508"])
+            return "raw_reaction_add", (
+                create_payload(self.panel, self.host, emoji),)
+        raise ValueError(scenario)
+
+    async def drain(self):
+        ''' Wait until the queued REST actions have finished
+'''
+        rroles = self.utils.get_cog("ReactionRoles")
+        while (self.utils.actions.workers or self.utils.dispatcher.workers
+               or rroles.pending):
+            await asyncio.sleep(0.001)
+
+    async def run(self, scenario, *, events, rate):
+        ''' Send events at a rate and measure the handler latencies
+'''
+        self.rest.calls.clear()
+        self.errors.clear()
+        latencies = []
+        async def handle(arrival, event_name, args):
+            await asyncio.sleep(max(0, arrival-time.perf_counter()))
+            await self.utils.dispatcher.handle(event_name, args, {})
+            latencies.append(time.perf_counter()-arrival)
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            handle(start+i/rate, *self.create_event(scenario))
+            for i in range(events)])
+        await self.drain()
+        elapsed = time.perf_counter()-start
+        quantiles = statistics.quantiles(latencies, n=100)
+        return {
+            "Events/sec": events/elapsed,
+            "p50 (ms)": quantiles[49]*1000,
+            "p99 (ms)": quantiles[98]*1000,
+            "REST calls/event": sum(self.rest.calls.values())/events,
+            "Errors": sum(self.errors.values())}
+
+async def benchmark_cogs(scenarios, *, events, rate, members, latency):
+    ''' Benchmark the cog handlers with fake events
+'''
+    harness = Harness(members=members, latency=latency)
+    print(f"Cogs ({members} members, {rate} events/sec, "
+          f"{latency*1000:g} ms REST latency)")
+    for scenario in scenarios:
+        results = await harness.run(scenario, events=events, rate=rate)
+        print(f"    {scenario}: " + ', '.join([
+            f"{k} {v:.2f}" for k, v in results.items()]))
+        for error, count in harness.errors.most_common():
+            print(f"        {count}x {error}")
+
+class StubHTTP:
+    ''' Answer the REST requests made during a replay
+        Created objects get payloads with new snowflakes
+'''
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.user = None
+
+    async def request(self, route, **kwargs):
+        self.calls[f"{route.method} {route.path}"] += 1
+        await asyncio.sleep(self.latency)
+        body = kwargs.get("json") or {}
+        if route.path == "/channels/{channel_id}/messages":
+            if route.method == "POST":
+                return self.message(route.channel_id, body.get("content"))
+        elif route.path == "/channels/{channel_id}/messages/{message_id}":
+            if route.method == "GET":
+                message_id = int(route.url.rsplit('/', 1)[-1])
+                return self.message(route.channel_id, id=message_id)
+        elif route.path == "/users/@me/channels":
+            return {
+                "id": str(next(SNOWFLAKES)), "type": 1,
+                "recipients": [{
+                    "id": str(body["recipient_id"]), "username": "Member",
+                    "discriminator": "0000", "avatar": None}]}
+        elif route.path == "/guilds/{guild_id}/roles":
+            if route.method == "POST":
+                return {
+                    "id": str(next(SNOWFLAKES)), "position": 1,
+                    "name": body.get("name", "new role"), "color": 0,
+                    "hoist": False, "managed": False, "mentionable": False,
+                    "permissions": "0"}
+        return None
+
+    def message(self, channel_id, content=None, *, id=None):
+        ''' Create a message payload sent by the bot
+'''
+        return {
+            "id": str(next(SNOWFLAKES) if id is None else id),
+            "channel_id": str(channel_id), "author": self.user,
+            "content": content or "", "tts": False, "pinned": False,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "edited_timestamp": None, "mention_everyone": False,
+            "mentions": [], "mention_roles": [], "attachments": [],
+            "embeds": [], "reactions": [], "type": 0}
+
+async def replay_capture(path, *, speed, latency):
+    ''' Replay a recorded capture through the bot against a stub API
+        A speed of 0 sends every event as fast as possible
+        Return the number of replayed events of each kind
+'''
+    utils = bot.Utils(
+        prefix="*", name="Replay", database=':memory:',
+        loop=asyncio.get_event_loop())
+    logging.getLogger().setLevel(logging.WARNING)
+    http = StubHTTP(latency)
+    utils.http.request = http.request
+    state = utils._connection
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        records = [json.loads(line) for line in file]
+    events = collections.Counter()
+    start = time.perf_counter()
+    for record in records:
+        if speed:
+            await asyncio.sleep(max(
+                0, start+record["time"]/speed-time.perf_counter()))
+        else:
+            await asyncio.sleep(0)
+        kind, data = record["t"], record["d"]
+        #Build the cache directly instead of waiting for guild chunks
+        if kind == "READY":
+            state.user = discord.ClientUser(state=state, data=data["user"])
+            http.user = data["user"]
+        elif kind == "GUILD_CREATE":
+            state._add_guild_from_data(data)
+        else:
+            state.parsers[kind](data)
+            events[kind] += 1
+    while utils.dispatcher.workers or utils.actions.workers:
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter()-start
+    total = sum(events.values())
+    rate = f"{speed:g}x speed" if speed else "max speed"
+    print(f"Replay of {path} ({rate}, {latency*1000:g} ms REST latency)")
+    print(f"    {total} events in {elapsed:.2f} s, "
+          f"{total/elapsed:.2f} events/sec, "
+          f"{sum(http.calls.values())/max(total, 1):.2f} REST calls/event")
+    for name in sorted(utils.metrics.histograms):
+        print(f"    {name}: "
+              f"p50 (ms) {utils.metrics.quantile(name, 0.5)*1000:.2f}, "
+              f"p99 (ms) {utils.metrics.quantile(name, 0.99)*1000:.2f}")
+    for route, count in http.calls.most_common():
+        print(f"    {route}: {count}")
+    await utils.close()
+    return events
+
+def main():
+    scenarios = [
+        "message", "message_delete", "reaction_roles", "guild_points",
+        "voice_control"]
+    parser = argparse.ArgumentParser(description="Benchmark the Utils bot")
+    parser.add_argument(
+        "--scenario", choices=scenarios, action="append",
+        help="scenario to run; may be repeated (default: all)")
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=500)
+    parser.add_argument("--members", type=int, default=1000)
+    parser.add_argument(
+        "--latency", type=float, default=50,
+        help="simulated REST latency in milliseconds")
+    parser.add_argument(
+        "--skip-censor", action="store_true",
+        help="skip the slow per-word censor comparison")
+    parser.add_argument(
+        "--replay", metavar="PATH",
+        help="replay a capture recorded with bot.py --record instead")
+    parser.add_argument(
+        "--speed", type=float, default=1,
+        help="replay speed multiplier; 0 replays as fast as possible")
+    args = parser.parse_args()
+    if args.replay is not None:
+        asyncio.get_event_loop().run_until_complete(replay_capture(
+            args.replay, speed=args.speed, latency=args.latency/1000))
+        return
+    if not args.skip_censor:
+        benchmark_censor()
+    asyncio.get_event_loop().run_until_complete(benchmark_cogs(
+        args.scenario or scenarios, events=args.events, rate=args.rate,
+        members=args.members, latency=args.latency/1000))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,31 @@
 #! python3
 # tests.py
 
+import asyncio
+import collections
+import contextlib
+import datetime
+import functools
+import gzip
+import io
 import json
+import logging
 import os
 import re
+import sqlite3
+import sys
+import tempfile
+import types
 import unittest
 
 import discord
 
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchmarks
+
 class TestMain(unittest.TestCase):
 
     def test_token(self):
@@ -21,11 +39,397 @@ class TestUtils(unittest.TestCase):
     def test_cog_files_exist(self):
         filenames = [
             'ghost_ping.txt', 'guild_points.txt', 'moderation.txt',
-            'reaction_roles.txt', 'voice_channel_control.txt']
+            'reaction_roles.txt', 'voice_channel_control.txt', 'utils.txt']
         for file in filenames:
             self.assertTrue(
                 os.path.exists(os.path.join('data', file)))
 
+    def open_file(self):
+        with open(os.path.join('data', 'utils.txt')) as file:
+            return json.load(file)
+
+    def test_file_format(self):
+        data = self.open_file()
+        self.assertEqual(
+            list(data),
+            ["config", "guilds", "notifications", "resolver", "dispatch",
+             "metrics", "logging"])
+        self.assertTrue(data["config"]["interval"] > 0)
+        self.assertTrue(data["guilds"]["capacity"] > 0)
+        self.assertEqual(
+            list(data["notifications"]),
+            ["window", "rate", "burst", "expire", "capacity"])
+        self.assertTrue(
+            all([i > 0 for i in data["notifications"].values()]))
+        self.assertTrue(data["resolver"]["capacity"] > 0)
+        self.assertEqual(
+            list(data["dispatch"]), ["concurrency", "queue_size"])
+        self.assertTrue(
+            all([isinstance(i, int) and i > 0
+                 for i in data["dispatch"].values()]))
+        self.assertEqual(list(data["metrics"]), ["active", "host", "port"])
+        self.assertTrue(isinstance(data["metrics"]["active"], bool))
+        self.assertTrue(isinstance(data["metrics"]["host"], str))
+        self.assertTrue(isinstance(data["metrics"]["port"], int))
+        self.assertEqual(list(data["logging"]), ["structured", "sampling"])
+        self.assertTrue(isinstance(data["logging"]["structured"], bool))
+        self.assertTrue(
+            all([0 <= i <= 1 for i in data["logging"]["sampling"].values()]))
+
+    def test_structured_logging(self):
+        sampling = bot.SamplingFilter({"message": 0, "moderation": 0})
+        records = {}
+        for event in ["message", "moderation"]:
+            records[event] = logging.makeLogRecord({
+                "msg": "%s: %s", "args": (event, {"guild": 1}),
+                "event": event, "fields": {"guild": 1}})
+        self.assertFalse(sampling.filter(records["message"]))
+        self.assertTrue(sampling.filter(records["moderation"]))
+        entry = json.loads(bot.JSONFormatter().format(records["moderation"]))
+        self.assertEqual(entry["event"], "moderation")
+        self.assertEqual(entry["guild"], 1)
+
+    def test_metrics_exposition(self):
+        dispatcher = bot.EventDispatcher(None, concurrency=1, queue_size=1)
+        utils = types.SimpleNamespace(latency=0.05, dispatcher=dispatcher)
+        metrics = bot.Metrics(
+            utils, active=False, host="127.0.0.1", port=9108)
+        for seconds in [0.0001, 0.002, 0.002, 20]:
+            metrics.observe("Moderation.spam", seconds)
+        self.assertEqual(metrics.quantile("Moderation.spam", 0.5), 0.0025)
+        self.assertEqual(
+            metrics.quantile("Moderation.spam", 0.99), float('inf'))
+        lines = metrics.exposition().splitlines()
+        self.assertIn(
+            'utils_handler_seconds_bucket'
+            '{handler="Moderation.spam",le="0.0025"} 3', lines)
+        self.assertIn(
+            'utils_handler_seconds_count{handler="Moderation.spam"} 4', lines)
+        self.assertIn('utils_gateway_latency_seconds 0.05', lines)
+
+    def test_metrics_port(self):
+        async def create():
+            utils = bot.Utils(
+                prefix="*", name="Test", database=':memory:', process=2,
+                loop=asyncio.get_event_loop())
+            utils.log_listener.stop()
+            utils.database.close()
+            return utils.metrics
+        metrics = asyncio.run(create())
+        #Each process of the bot serves metrics on its own port
+        self.assertEqual(metrics.port, self.open_file()["metrics"]["port"]+2)
+
+    def test_event_dispatcher(self):
+        handled = []
+        async def on_message(message):
+            await asyncio.sleep(0)
+            handled.append(message.id)
+        utils = types.SimpleNamespace(
+            extra_events={"on_message": [on_message]},
+            metrics=types.SimpleNamespace(active=False))
+        dispatcher = bot.EventDispatcher(utils, concurrency=1, queue_size=2)
+        async def dispatch_messages():
+            for i in range(3):
+                message = types.SimpleNamespace(
+                    id=i, guild=types.SimpleNamespace(id=1),
+                    channel=types.SimpleNamespace(id=1))
+                key = dispatcher.route("message", (message,))
+                dispatcher.submit(key, "message", (message,), {})
+            self.assertEqual(dispatcher.depths(), {1: 2})
+            await asyncio.sleep(0.1)
+        asyncio.run(dispatch_messages())
+        self.assertEqual(handled, [0, 1])
+        self.assertEqual(dispatcher.dropped[1], 1)
+        self.assertEqual(dispatcher.queues, {})
+
+    def test_check_commands_direct_message(self):
+        moderation = types.SimpleNamespace(guild_data=lambda guild_id: {
+            "actives": {"commands": guild_id is not None}})
+        utils = types.SimpleNamespace(get_cog=lambda name: moderation)
+        ctx = types.SimpleNamespace(guild=None)
+        self.assertFalse(asyncio.run(bot.Utils.check_commands(utils, ctx)))
+
+    def test_wait_for_queued_events(self):
+        async def run():
+            harness = benchmarks.Harness(members=5, latency=0)
+            utils = harness.utils
+            messages = [
+                benchmarks.FakeMessage(harness.general, m, "gg")
+                for m in harness.guild.members[:3]]
+            waiter = asyncio.ensure_future(utils.wait_for(
+                "message", check=lambda m: m.id == messages[1].id,
+                timeout=1))
+            await asyncio.sleep(0)
+            for message in messages:
+                utils.dispatch("message", message)
+            result = await waiter
+            await harness.drain()
+            utils.log_listener.stop()
+            utils.database.close()
+            return messages, result, utils._listeners
+        messages, result, listeners = asyncio.run(run())
+        #Events handled in the dispatcher queues still resolve wait_for
+        self.assertIs(result, messages[1])
+        self.assertNotIn("message", listeners)
+
+    def test_role_index(self):
+        roles = [discord.Object(id=i) for i in range(3)]
+        members = [
+            types.SimpleNamespace(id=10, roles=roles[:2]),
+            types.SimpleNamespace(id=11, roles=roles[:1])]
+        index = bot.RoleIndex()
+        index.build(types.SimpleNamespace(roles=roles, members=members))
+        self.assertEqual(
+            [index.count(r) for r in roles], [2, 1, 0])
+        self.assertTrue(index.is_orphaned(roles[2]))
+        after = types.SimpleNamespace(id=10, roles=roles[:1]+roles[2:])
+        index.update(members[0], after)
+        self.assertTrue(index.is_orphaned(roles[1]))
+        self.assertEqual(index.count(roles[2]), 1)
+
+    def test_action_scheduler_role_changes(self):
+        edits = []
+        async def edit(*, roles):
+            edits.append(set(roles))
+        roles = [discord.Object(id=i) for i in range(4)]
+        member = types.SimpleNamespace(
+            id=1, guild=types.SimpleNamespace(id=1), roles=roles[:2],
+            edit=edit)
+        async def change_roles():
+            actions = bot.ActionScheduler()
+            actions.edit_roles(member, add=[roles[2]])
+            await actions.edit_roles(
+                member, add=[roles[3]], remove=[roles[1], roles[2]])
+        asyncio.run(change_roles())
+        self.assertEqual(edits, [{roles[3]}])
+
+    def test_action_scheduler_voice_edits(self):
+        running = []
+        edited = []
+        guild = types.SimpleNamespace(id=1)
+        def create_member(member_id, mute):
+            async def edit(*, mute):
+                running.append(member_id)
+                edited.append(len(running))
+                await asyncio.sleep(0.01)
+                running.remove(member_id)
+            return types.SimpleNamespace(
+                id=member_id, guild=guild, edit=edit,
+                voice=types.SimpleNamespace(mute=mute))
+        members = [create_member(i, i == 0) for i in range(5)]
+        async def mute():
+            actions = bot.ActionScheduler(member_edits=3)
+            await actions.edit_voices(members, mute=True)
+            return actions
+        actions = asyncio.run(mute())
+        #Members already muted are skipped and edits run concurrently up
+        #to the limit of the guild
+        self.assertEqual(edited, [1, 2, 3, 1])
+        self.assertEqual(len(actions.guild_limits), 0)
+        self.assertEqual(actions.workers, {})
+
+    def test_action_scheduler_guild_limit(self):
+        running = []
+        edited = []
+        guild = types.SimpleNamespace(id=1)
+        roles = [discord.Object(id=i) for i in range(2)]
+        def create_member(member_id):
+            async def edit(**changes):
+                running.append(member_id)
+                edited.append(len(running))
+                await asyncio.sleep(0.01)
+                running.remove(member_id)
+            return types.SimpleNamespace(
+                id=member_id, guild=guild, edit=edit, roles=roles[:1])
+        members = [create_member(i) for i in range(3)]
+        async def change_roles():
+            actions = bot.ActionScheduler(member_edits=2)
+            await asyncio.gather(*[
+                actions.edit_roles(m, add=roles[1:]) for m in members]+[
+                actions.edit_voices(members, mute=True)])
+        members[2].voice = None
+        for member in members[:2]:
+            member.voice = types.SimpleNamespace(mute=False)
+        asyncio.run(change_roles())
+        #Role and voice edits in a guild never exceed the limit
+        self.assertEqual(len(edited), 5)
+        self.assertEqual(max(edited), 2)
+
+    def test_panel_registry(self):
+        database = sqlite3.connect(':memory:')
+        panels = bot.PanelRegistry(database, lambda guild: True)
+        message = types.SimpleNamespace(
+            id=1, guild=types.SimpleNamespace(id=5),
+            channel=types.SimpleNamespace(id=2))
+        panels.register(message, "VoiceChannelControl", "claim", member=3)
+        panels.update(1, "control", channel=4)
+        self.assertIsNone(panels.get(1, "GuildPoints"))
+        panels = bot.PanelRegistry(database, lambda guild: True)
+        panel = panels.get(1, "VoiceChannelControl")
+        self.assertEqual(panel["kind"], "control")
+        self.assertEqual(panel["state"], {"member": 3, "channel": 4})
+        panels.remove(1)
+        self.assertEqual(
+            bot.PanelRegistry(database, lambda guild: True).panels, {})
+
+    def test_timer_scheduler(self):
+        deletions = []
+        async def delete_messages(messages):
+            deletions.append([m.id for m in messages])
+        channel = types.SimpleNamespace(
+            id=1, delete_messages=delete_messages)
+        utils = types.SimpleNamespace(
+            database=sqlite3.connect(':memory:'),
+            get_channel=lambda i: channel, owns=lambda guild: True)
+        guild = types.SimpleNamespace(id=1)
+        async def run_timers():
+            timers = bot.TimerScheduler(utils)
+            timers.start()
+            for i in range(3):
+                timers.delete_later(types.SimpleNamespace(
+                    id=i, guild=guild, channel=channel), 0)
+            timers.schedule(
+                guild, 60, "delete_message", channel=1, message=3)
+            await asyncio.sleep(0.1)
+        asyncio.run(run_timers())
+        self.assertEqual(deletions, [[0, 1, 2]])
+        self.assertEqual(len(bot.TimerScheduler(utils).heap), 1)
+
+    def test_notifier(self):
+        sent = []
+        created = []
+        def create_member(member_id):
+            channel = types.SimpleNamespace()
+            async def send(embed):
+                sent.append((member_id, embed))
+            async def create_dm():
+                created.append(member_id)
+                return channel
+            channel.send = send
+            return types.SimpleNamespace(id=member_id, create_dm=create_dm)
+        def create_embed(title):
+            embed = discord.Embed(title=title, color=0x00ff00)
+            embed.add_field(name="Tickets", value=1)
+            return embed
+        members = [create_member(i) for i in range(2)]
+        async def notify():
+            notifier = bot.Notifier(
+                window=0.01, rate=1, burst=2, expire=0, capacity=10)
+            for title in ["A", "B", "C"]:
+                notifier.notify(members[0], create_embed(title))
+            await asyncio.sleep(0.05)
+            notifier.notify(members[0], create_embed("D"))
+            notifier.notify(members[1], create_embed("E"))
+            await asyncio.sleep(0.05)
+            return notifier
+        notifier = asyncio.run(notify())
+        #Notifications within the window are combined into one embed
+        self.assertEqual([m for m, _ in sent], [0, 0])
+        self.assertEqual(
+            [f.name for f in sent[0][1].fields], ["A", "B", "C"])
+        self.assertEqual(sent[1][1].title, "D")
+        self.assertEqual(created, [0])
+        #Notifications are dropped once the rate limit is reached
+        self.assertEqual(notifier.dropped, 1)
+
+    def test_resolver(self):
+        roles = {
+            i: types.SimpleNamespace(id=i, name=f"Role {i}")
+            for i in range(3)}
+        guild = types.SimpleNamespace(
+            id=0, roles=list(roles.values()), channels=[],
+            get_role=roles.get)
+        resolver = bot.Resolver(capacity=2)
+        self.assertIs(resolver.role(guild, "1"), roles[1])
+        self.assertIsNone(resolver.role(guild, 5))
+        #Deleted roles are named instead of raising errors
+        self.assertEqual(
+            resolver.display(guild, "role", [0, 5]),
+            ["Role 0", "deleted role (5)"])
+        #Display names are cached until invalidated
+        roles[0].name = "Renamed"
+        self.assertEqual(resolver.name(guild, "role", 0), "Role 0")
+        resolver.invalidate("role", 0)
+        self.assertEqual(resolver.name(guild, "role", 0), "Renamed")
+        resolver.display(guild, "role", [1, 2])
+        self.assertEqual(len(resolver.names), 2)
+        #Names are found once and then looked up by ID
+        self.assertIs(resolver.find(guild, "role", "Role 2"), roles[2])
+        self.assertEqual(resolver.named[(0, "role", "Role 2")], 2)
+        roles[2].name = "Other"
+        self.assertIsNone(resolver.find(guild, "role", "Role 2"))
+        self.assertNotIn((0, "role", "Role 2"), resolver.named)
+
+    def test_event_recorder(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "capture.jsonl.gz")
+            recorder = bot.EventRecorder(path)
+            messages = [
+                {"op": 0, "t": "MESSAGE_CREATE", "d": {"id": "1"}},
+                {"op": 0, "t": "TYPING_START", "d": {}},
+                {"op": 11, "d": None},
+                {"op": 0, "t": "MESSAGE_DELETE", "d": {"id": "1"}}]
+            for msg in messages:
+                asyncio.run(recorder.record(msg))
+            recorder.close()
+            with gzip.open(path, 'rt') as file:
+                records = [json.loads(line) for line in file]
+        self.assertEqual(
+            [(r["t"], r["d"]) for r in records],
+            [("MESSAGE_CREATE", {"id": "1"}),
+             ("MESSAGE_DELETE", {"id": "1"})])
+        self.assertEqual(
+            bot.shard_recording("capture.jsonl.gz", [4, 7]),
+            "capture-4-7.jsonl.gz")
+
+    def test_config_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "example.txt")
+            with open(path, 'w') as file:
+                json.dump({"channels": [1, 2]}, file)
+            reloads = []
+            config = bot.ConfigStore(directory)
+            config.load(
+                "example", lambda data: frozenset(data["channels"]),
+                lambda old, new: reloads.append((old, new)))
+            self.assertEqual(config["example"], frozenset([1, 2]))
+            config.reload()
+            self.assertEqual(reloads, [])
+            with open(path, 'w') as file:
+                json.dump({"channels": [3]}, file)
+            os.utime(path, ns=(0, 1))
+            config.reload()
+            self.assertEqual(config["example"], frozenset([3]))
+            self.assertEqual(reloads, [(frozenset([1, 2]), frozenset([3]))])
+            #Invalid files keep the previous config
+            with open(path, 'w') as file:
+                file.write("{")
+            os.utime(path, ns=(0, 2))
+            config.reload()
+            self.assertEqual(config["example"], frozenset([3]))
+            self.assertEqual(len(reloads), 1)
+            #Guild files override the global file
+            self.assertIs(config.guild("example", 1), config["example"])
+            os.makedirs(os.path.join(directory, 'guilds', '1'))
+            with open(config.path("example", 1), 'w') as file:
+                json.dump({"channels": [4]}, file)
+            config.reload()
+            self.assertEqual(config.guild("example", 1), frozenset([4]))
+            self.assertEqual(config.guild("example", 2), frozenset([3]))
+
+    def test_guild_cache(self):
+        evicted = []
+        cache = bot.GuildCache(
+            lambda guild_id: {"guild": guild_id}, capacity=2,
+            evict=lambda guild_id, state: evicted.append(guild_id))
+        self.assertEqual(cache[1], {"guild": 1})
+        cache[2]
+        cache[1]
+        cache[3]
+        self.assertEqual(evicted, [2])
+        self.assertTrue(1 in cache and 3 in cache)
+        self.assertIsNone(cache.peek(2))
+
 class TestGhostPingCog(unittest.TestCase):
 
     def open_file(self):
@@ -34,9 +438,39 @@ class TestGhostPingCog(unittest.TestCase):
 
     def test_pings_file_format(self):
         data = self.open_file()
-        self.assertEqual(list(data), ["everyone", "roles", "members"])
+        self.assertEqual(
+            list(data), ["everyone", "roles", "members", "cache"])
         self.assertTrue(
-            all([isinstance(data[i], bool) for i in data]))
+            all([isinstance(data[i], bool) for i in data if i != "cache"]))
+        self.assertEqual(list(data["cache"]), ["ttl", "capacity", "content"])
+        self.assertTrue(all([i > 0 for i in data["cache"].values()]))
+
+    def create_message(self, message_id, content):
+        return types.SimpleNamespace(
+            id=message_id, guild=types.SimpleNamespace(id=1),
+            channel=types.SimpleNamespace(id=2),
+            author=types.SimpleNamespace(id=3, name="Member"),
+            content=content, mention_everyone=False, raw_role_mentions=[],
+            raw_mentions=[
+                int(i) for i in re.findall(r"<@!?([0-9]+)>", content)])
+
+    def test_mention_cache(self):
+        cache = bot.MentionCache(ttl=60, capacity=2, content=10)
+        record = cache.add(self.create_message(1, "hello <@4> and <@!5>"))
+        self.assertEqual(record.members, (4, 5))
+        self.assertEqual(record.content, "hello <@4>")
+        self.assertFalse(hasattr(record, '__dict__'))
+        cache.add(self.create_message(2, "<@4>"))
+        cache.add(self.create_message(3, "<@5>"))
+        #The oldest record is evicted once the cache is full
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.pop(1))
+        self.assertEqual(cache.pop(2).author_name, "Member")
+        self.assertIsNone(cache.pop(2))
+        #Expired records are not returned
+        cache = bot.MentionCache(ttl=-1, capacity=2, content=10)
+        cache.add(self.create_message(1, "<@4>"))
+        self.assertIsNone(cache.pop(1))
 
 class TestGuildPointsCog(unittest.TestCase):
 
@@ -50,11 +484,55 @@ class TestGuildPointsCog(unittest.TestCase):
 
     def test_file_format(self):
         data = self.open_file()
-        self.assertEqual(list(data), ["tiers", "bounty"])
+        self.assertEqual(list(data), ["tiers", "bounty", "sync", "draw"])
         self.assertTrue(all([isinstance(i, int) for i in data["tiers"]]))
         self.assertTrue(
             all([isinstance(data["tiers"][i], int) for i in data["tiers"]]))
         self.assertTrue(isinstance(data["bounty"], int))
+        self.assertEqual(list(data["sync"]), ["active", "rate"])
+        self.assertTrue(isinstance(data["sync"]["active"], bool))
+        self.assertTrue(data["sync"]["rate"] > 0)
+        self.assertEqual(list(data["draw"]), ["minimum", "winners"])
+        self.assertTrue(data["draw"]["winners"] > 0)
+
+    def test_bounty_entries_restored(self):
+        async def run():
+            harness = benchmarks.Harness(members=20, latency=0)
+            await harness.run("guild_points", events=20, rate=1000)
+            bounty = harness.bounty.id
+            entries = dict(
+                harness.utils.get_cog("GuildPoints").bounties[bounty].tickets)
+            #A new cog on the same database restores the live entries
+            restarted = bot.GuildPoints(harness.utils)
+            harness.utils.log_listener.stop()
+            harness.utils.database.close()
+            return entries, restarted.bounties[bounty].tickets
+        entries, restored = asyncio.run(run())
+        self.assertTrue(entries)
+        self.assertEqual(restored, entries)
+
+    def test_bounty_channel(self):
+        async def run():
+            harness = benchmarks.Harness(members=5, latency=0)
+            cog = harness.utils.get_cog("GuildPoints")
+            author = harness.guild.members[0]
+            message = benchmarks.FakeMessage(harness.general, author, "gg")
+            #Bounties are not created without the channel of the guild
+            await cog.create_bounty(message)
+            missing = dict(harness.general.messages)
+            #Guilds override the channel bounties are sent in
+            bounty = harness.guild.add_channel("bounties")
+            guild_data = cog.guild_data
+            cog.guild_data = lambda guild_id: dict(
+                guild_data(guild_id), bounty=bounty.id)
+            await cog.create_bounty(message)
+            await harness.drain()
+            harness.utils.log_listener.stop()
+            harness.utils.database.close()
+            return missing, harness.general.messages, bounty.messages
+        missing, general, bounties = asyncio.run(run())
+        self.assertEqual(missing, general)
+        self.assertEqual(len(bounties), 1)
 
     def test_reaction_unicodes(self):
         reactions = {
@@ -66,6 +544,224 @@ class TestGuildPointsCog(unittest.TestCase):
         for uni in reactions:
             self.assertEqual(uni, reactions[uni])
 
+    def test_ledger(self):
+        database = sqlite3.connect(':memory:')
+        ledger = bot.Ledger(database)
+        member = types.SimpleNamespace(
+            id=1, guild=types.SimpleNamespace(id=1))
+        self.assertFalse(member in ledger)
+        self.assertEqual(ledger.add(member, "tickets", 5), (0, 5))
+        self.assertEqual(ledger.add(member, "tickets", -2), (5, 3))
+        self.assertEqual(ledger.get(member, "points"), 0)
+        ledger.flush()
+        ledger = bot.Ledger(database)
+        self.assertEqual(ledger.get(member, "tickets"), 3)
+        #Changed balances are written when their guild is evicted
+        ledger = bot.Ledger(database, capacity=1)
+        ledger.add(member, "points", 4)
+        ledger.get(types.SimpleNamespace(
+            id=1, guild=types.SimpleNamespace(id=2)), "points")
+        self.assertFalse(1 in ledger.balances)
+        self.assertEqual(bot.Ledger(database).get(member, "points"), 4)
+
+    def test_legacy_balance(self):
+        database = sqlite3.connect(':memory:')
+        cog = bot.GuildPoints.__new__(bot.GuildPoints)
+        cog.ledger = bot.Ledger(database)
+        cog.legacy_regexes = {
+            "points": re.compile(r'_Guild Points: ([0-9]+)_'),
+            "tickets": re.compile(r'_Bounty Tickets: ([0-9]+)_')}
+        deletes = []
+        async def delete():
+            deletes.append(None)
+            raise discord.NotFound(
+                types.SimpleNamespace(status=404, reason="Not Found"),
+                "Unknown Role")
+        role = discord.Object(id=1)
+        role.name, role.delete = "_Guild Points: 40_", delete
+        async def edit(*, roles):
+            member.roles = roles
+        guild = types.SimpleNamespace(id=1)
+        default = discord.Object(id=0)
+        default.name = "@everyone"
+        member = types.SimpleNamespace(
+            id=2, guild=guild, roles=[default, role], edit=edit)
+        tasks = []
+        cog.bot = types.SimpleNamespace(
+            role_index=bot.RoleIndex(), actions=bot.ActionScheduler(),
+            loop=types.SimpleNamespace(create_task=tasks.append))
+        cog.bot.role_index.add(member, member.roles)
+        self.assertEqual(cog.balance(member, "points"), 40)
+        #The imported balance is written before the role is removed
+        self.assertEqual(bot.Ledger(database).get(member, "points"), 40)
+        #Roles which were already deleted are ignored
+        asyncio.run(tasks[0])
+        self.assertEqual(len(deletes), 1)
+        self.assertNotIn(role, member.roles)
+
+    def test_ledger_ranking(self):
+        ledger = bot.Ledger(sqlite3.connect(':memory:'))
+        guild = types.SimpleNamespace(id=1)
+        members = [types.SimpleNamespace(id=i, guild=guild) for i in range(5)]
+        for member, points in zip(members, [3, 7, 7, 1, 0]):
+            ledger.set(member, "points", points)
+        self.assertEqual(ledger.top(1, 3), [(1, 7), (2, 7), (0, 3)])
+        self.assertEqual(ledger.rank(members[2]), 1)
+        self.assertEqual(ledger.rank(members[0]), 3)
+        #Rankings are updated with the balances
+        ledger.add(members[3], "points", 9)
+        ledger.add(members[4], "tickets", 2)
+        self.assertEqual(ledger.top(1, 2), [(3, 10), (1, 7)])
+        self.assertEqual(ledger.rank(members[4]), 5)
+        self.assertEqual(len(ledger.ranking(1)), 5)
+
+    def test_legacy_ranking(self):
+        cog = bot.GuildPoints.__new__(bot.GuildPoints)
+        cog.ledger = bot.Ledger(sqlite3.connect(':memory:'))
+        cog.legacy_regexes = {
+            "points": re.compile(r'_Guild Points: ([0-9]+)_'),
+            "tickets": re.compile(r'_Bounty Tickets: ([0-9]+)_')}
+        cog.imported = set()
+        roles = [discord.Object(id=i) for i in range(3)]
+        for role, name in zip(roles, [
+                "@everyone", "_Guild Points: 40_", "_Bounty Tickets: 2_"]):
+            role.name = name
+        guild = types.SimpleNamespace(id=1, roles=roles)
+        members = {
+            i: types.SimpleNamespace(id=i, guild=guild, roles=roles[:1])
+            for i in range(3)}
+        members[1].roles = roles[:2]
+        members[2].roles = roles[:1]+roles[2:]
+        guild.members = list(members.values())
+        guild.get_member = members.get
+        tasks, edits, deleted = [], [], []
+        async def edit_roles(member, *, remove):
+            edits.append((member.id, [role.id for role in remove]))
+            member.roles = [r for r in member.roles if r not in remove]
+        async def delete(role):
+            deleted.append(role.id)
+        for role in roles:
+            role.delete = functools.partial(delete, role)
+        cog.bot = types.SimpleNamespace(
+            role_index=bot.RoleIndex(),
+            actions=types.SimpleNamespace(edit_roles=edit_roles),
+            loop=types.SimpleNamespace(create_task=tasks.append))
+        cog.bot.role_index.build(guild)
+        cog.ledger.set(members[0], "points", 5)
+        #Members with legacy balances are ranked before they use the cog
+        cog.import_legacy(guild)
+        self.assertEqual(cog.ledger.top(1, 3), [(1, 40), (0, 5), (2, 0)])
+        self.assertEqual(cog.ledger.get(members[2], "tickets"), 2)
+        self.assertEqual(cog.imported, {1})
+        #A single background task removes the legacy roles in batches
+        self.assertEqual(len(tasks), 1)
+        asyncio.run(tasks[0])
+        self.assertEqual(sorted(edits), [(1, [1]), (2, [2])])
+        self.assertEqual(sorted(deleted), [1, 2])
+        cog.import_legacy(guild)
+        self.assertEqual(len(tasks), 1)
+
+    def test_bounty_entries(self):
+        entries = bot.BountyEntries()
+        for member, tickets in enumerate([1, 9, 9, 3, 1]):
+            entries.enter(member, tickets)
+        self.assertEqual((len(entries), entries.total), (5, 23))
+        self.assertEqual(entries.withdraw(1), 9)
+        self.assertEqual(entries.withdraw(0), 1)
+        self.assertFalse(0 in entries)
+        self.assertEqual(entries.get(2), 9)
+        self.assertEqual(entries.total, 13)
+        winners = entries.draw(5)
+        self.assertEqual(sorted(winners), [2, 3, 4])
+        self.assertEqual((len(entries), entries.total), (0, 0))
+        #Winners are drawn with a weight of their tickets
+        wins = collections.Counter()
+        for _ in range(2000):
+            entries.enter(0, 1)
+            entries.enter(1, 9)
+            wins[entries.draw()[0]] += 1
+            entries.withdraw(next(iter(entries.tickets)))
+        self.assertTrue(1600 < wins[1] < 1990)
+
+    def test_give_many(self):
+        cog = bot.GuildPoints.__new__(bot.GuildPoints)
+        cog.ledger = bot.Ledger(sqlite3.connect(':memory:'))
+        cog.legacy_regexes = {}
+        guild = types.SimpleNamespace(id=1)
+        members = [discord.Object(id=i) for i in range(4)]
+        for member in members:
+            member.roles = []
+        for member in members[:3]:
+            member.guild = guild
+        balances, errors, warnings = asyncio.run(
+            cog.give_many(members, "tickets", 4))
+        self.assertEqual(list(balances.values()), [(0, 4)]*3)
+        self.assertEqual(list(errors), [members[3]])
+        self.assertEqual(warnings, {})
+        #Members whose tier notification fails keep their new balance
+        async def parse_tiers(member, ptrange):
+            if member.id == 1:
+                raise discord.HTTPException(
+                    types.SimpleNamespace(status=500, reason="Error"), '')
+        cog.parse_tiers = parse_tiers
+        balances, errors, warnings = asyncio.run(
+            cog.give_many(members[:3], "points", 4))
+        self.assertEqual(list(balances.values()), [(0, 4)]*3)
+        self.assertEqual((errors, list(warnings)), ({}, [members[1]]))
+        lines = [f"Member {i}: 4" for i in range(100)]
+        summary = bot.GuildPoints.summarize(lines)
+        self.assertTrue(len(summary) <= 1024)
+        self.assertTrue(summary.endswith("more"))
+        self.assertEqual(bot.GuildPoints.summarize(lines[:2]), '\n'.join(
+            lines[:2]))
+
+    def test_tier_engine(self):
+        tiers = bot.GuildPoints.compile_config(self.open_file())
+        engine = bot.TierEngine()
+        self.assertEqual(engine.reached(tiers, 0), 0)
+        self.assertEqual(engine.reached(tiers, 5), 2)
+        self.assertEqual(engine.reached(tiers, 1000), len(tiers["roles"]))
+        self.assertEqual(list(engine.crossed(tiers, 4, 20)), [1, 2, 3])
+        self.assertEqual(list(engine.crossed(tiers, 20, 20)), [])
+        roles = {r: discord.Object(id=r) for r in tiers["roles"]}
+        guild = types.SimpleNamespace(get_role=roles.get)
+        role = engine.role(guild, tiers, 0)
+        self.assertEqual(role.id, tiers["roles"][0])
+        roles.clear()
+        self.assertIs(engine.role(guild, tiers, 0), role)
+        engine.invalidate(role)
+        self.assertIsNone(engine.role(guild, tiers, 0))
+
+    def test_tier_sync_override(self):
+        data = bot.GuildPoints.compile_config(self.open_file())
+        data["sync"]["active"] = False
+        override = dict(data, sync={"active": True, "rate": 1})
+        cog = bot.GuildPoints.__new__(bot.GuildPoints)
+        cog.guild_data = lambda guild_id: override if guild_id == 2 else data
+        cog.tiers = bot.TierEngine()
+        cog.tier_syncs = collections.OrderedDict()
+        cog.sync_task = None
+        tasks = []
+        def create_task(coro):
+            coro.close()
+            tasks.append(coro)
+            return types.SimpleNamespace(done=lambda: False)
+        cog.bot = types.SimpleNamespace(
+            notifier=types.SimpleNamespace(notify=lambda member, embed: None),
+            loop=types.SimpleNamespace(create_task=create_task))
+        roles = {}
+        for role_id in data["roles"]:
+            roles[role_id] = discord.Object(id=role_id)
+            roles[role_id].name, roles[role_id].color = "Tier", 0
+        for guild_id in [1, 2]:
+            member = types.SimpleNamespace(
+                id=5, guild=types.SimpleNamespace(
+                    id=guild_id, get_role=roles.get))
+            asyncio.run(cog.parse_tiers(member, [0, 10]))
+        #Only the guild which activated the sync has members synced
+        self.assertEqual(list(cog.tier_syncs), [(2, 5)])
+        self.assertEqual(len(tasks), 1)
+
     def test_exponential_function(self):
         upper = 10
         nums = [(1/2)**n for n in range(1, upper)]
@@ -128,6 +824,15 @@ class TestModerationCog(unittest.TestCase):
             all([isinstance(k, int)
                  for i in data for j in data[i] for k in data[i][j]]))
 
+    def test_compile_config(self):
+        config = bot.Moderation.compile_config(self.open_file())
+        self.assertEqual(
+            list(config["actives"]), ["commands", "spam", "censor"])
+        self.assertTrue(all([
+            isinstance(config["commands"][i][j], frozenset)
+            for i in config["commands"] for j in config["commands"][i]]))
+        self.assertEqual(config["matcher"].search("b.a.s.t.a.r.d"), "bastard")
+
     def test_censor_regular_expression(self):
         included, excluded = self.open_file()["characters"]
         word = "badword"
@@ -145,6 +850,46 @@ class TestModerationCog(unittest.TestCase):
             profane = match_true and match_none is None
             self.assertEqual(cases[case], profane)
 
+    def test_blacklist_matcher(self):
+        characters = self.open_file()["characters"]
+        matcher = bot.BlacklistMatcher(["badword", "bad-word"], characters)
+        cases = {
+            "badword": True, "BADWORD": True, "a-badword": True,
+            "notbadword": False, "badwordfake": False,
+            "~b@a$d^w*o)r+d}": True, "B1A3D5W7O9R-D": True,
+            "bad-word": True, "notbad-word": True, "clean": False}
+        for case in cases:
+            profane = matcher.search(case) is not None
+            self.assertEqual(cases[case], profane)
+
+    def create_message(self, msg_id, seconds, *, author=1, channel=1):
+        start = datetime.datetime(2021, 1, 1)
+        return types.SimpleNamespace(
+            id=msg_id, guild=types.SimpleNamespace(id=1),
+            channel=types.SimpleNamespace(id=channel),
+            author=types.SimpleNamespace(id=author),
+            created_at=start+datetime.timedelta(seconds=seconds))
+
+    def test_spam_tracker(self):
+        tracker = bot.SpamTracker(3, 10)
+        for i in range(3):
+            self.assertEqual(
+                tracker.track(self.create_message(i, i)), [])
+        self.assertEqual(
+            tracker.track(self.create_message(3, 3)), [0, 1, 2, 3])
+        self.assertEqual(
+            tracker.track(self.create_message(4, 30)), [])
+        self.assertEqual(
+            tracker.track(self.create_message(5, 31, author=2)), [])
+
+    def test_spam_tracker_eviction(self):
+        tracker = bot.SpamTracker(3, 10, capacity=2)
+        for author in range(5):
+            tracker.track(self.create_message(author, 0, author=author))
+        self.assertEqual(len(tracker.buckets), 2)
+        tracker.track(self.create_message(5, 60))
+        self.assertEqual(len(tracker.buckets), 1)
+
 class TestReactionRolesCog(unittest.TestCase):
 
     def open_messages_file(self):
@@ -162,6 +907,121 @@ class TestReactionRolesCog(unittest.TestCase):
             all([isinstance(k, int)
                  for i in data for j in data[i] for k in data[i][j]]))
 
+    def test_reaction_state(self):
+        emojis = {"Red": (1, 0), "Blue": (2, 0), "Green": (3,)}
+        state = bot.ReactionState()
+        for name in ["Red", "Blue"]:
+            state.add(10, 5, types.SimpleNamespace(name=name))
+        #The newest choice replaces the other reactions
+        add, remove, extra = state.resolve(emojis, 10, 5, "Blue")
+        self.assertEqual(add, {2, 0})
+        self.assertEqual(remove, {1, 3})
+        self.assertEqual([e.name for e in extra], ["Red"])
+        self.assertEqual(list(state.get(10, 5)), ["Blue"])
+        #Reactions removed by the bot are not removed again
+        self.assertFalse(state.remove(10, 5, "Red"))
+        self.assertTrue(state.remove(10, 5, "Blue"))
+        self.assertEqual(
+            state.resolve(emojis, 10, 5), (set(), {0, 1, 2, 3}, []))
+        self.assertEqual(state.reactions, {})
+
+    def test_reconcile_panel(self):
+        edits = {}
+        roles = {i: discord.Object(id=i) for i in range(3)}
+        def create_member(member_id, role_ids):
+            member = discord.Object(id=member_id)
+            member.bot = False
+            member.roles = [roles[0]]+[roles[i] for i in role_ids]
+            async def edit(*, roles):
+                edits[member_id] = {r.id for r in roles}
+            member.edit = edit
+            return member
+        members = {
+            4: create_member(4, []), 5: create_member(5, [1, 2]),
+            6: create_member(6, [1, 2])}
+        async def users(*, limit, after):
+            for member_id in [4, 6]:
+                if after is None or member_id > after.id:
+                    yield members[member_id]
+        reaction = types.SimpleNamespace(emoji="Red", users=users)
+        guild = types.SimpleNamespace(
+            id=1, get_member=members.get, get_role=roles.get,
+            roles=list(roles.values()), members=list(members.values()))
+        for member in members.values():
+            member.guild = guild
+        message = types.SimpleNamespace(
+            id=10, guild=guild, reactions=[reaction])
+        fetches = collections.Counter()
+        def create_channel(channel_id, messages):
+            async def fetch_message(message_id):
+                fetches[channel_id] += 1
+                if message_id not in messages:
+                    raise discord.NotFound(
+                        types.SimpleNamespace(status=404, reason="Not Found"),
+                        "Unknown Message")
+                return messages[message_id]
+            return types.SimpleNamespace(
+                id=channel_id, fetch_message=fetch_message)
+        channel = create_channel(2, {10: message})
+        guild.text_channels = [create_channel(3, {}), channel]
+        guild.get_channel = {2: channel}.get
+        message.channel = channel
+        other = types.SimpleNamespace(
+            id=7, text_channels=[create_channel(8, {})])
+        database = sqlite3.connect(':memory:')
+        cog = bot.ReactionRoles.__new__(bot.ReactionRoles)
+        cog.bot = types.SimpleNamespace(
+            panels=bot.PanelRegistry(database, lambda guild: True),
+            resolver=bot.Resolver(), role_index=bot.RoleIndex(),
+            actions=bot.ActionScheduler(), guilds=[other, guild],
+            get_guild={1: guild, 7: other}.get)
+        cog.bot.role_index.build(guild)
+        cog.state = bot.ReactionState()
+        cog.pending = {}
+        cog.batch = 1
+        cog.concurrency = 2
+        emojis = {"Red": (1,), "Blue": (2,)}
+        cog.bot.config = {"reaction_roles": {10: emojis, 11: emojis}}
+        cog.guild_data = lambda guild_id: cog.messages
+        def reconcile():
+            asyncio.run(cog.reconcile())
+        reconcile()
+        #Only the members missing the roles of their reactions are edited
+        #and roles given without a reaction are kept
+        self.assertEqual(edits, {4: {1}})
+        panel = bot.PanelRegistry(database, lambda guild: True).get(
+            10, "ReactionRoles")
+        self.assertEqual(panel["channel"], 2)
+        self.assertEqual(panel["state"], {"cursors": {}})
+        #Panels are searched for once and then fetched from their channel
+        self.assertEqual(fetches, {8: 2, 3: 2, 2: 2})
+        self.assertEqual(
+            cog.bot.panels.get(11, "ReactionRoles")["state"],
+            {"guilds": [1, 7]})
+        fetches.clear()
+        reconcile()
+        self.assertEqual(fetches, {2: 1})
+        #An interrupted pass resumes after the last member recorded
+        edits.clear()
+        cog.state = bot.ReactionState()
+        members[4].roles = [roles[0]]
+        members[5].roles = [roles[0], roles[1]]
+        cog.bot.panels.update(10, "panel", cursors={"Red": 4})
+        reconcile()
+        self.assertEqual(edits, {})
+        members[6].roles = [roles[0]]
+        cog.bot.panels.update(10, "panel", cursors={"Red": 4})
+        reconcile()
+        self.assertEqual(edits, {6: {1}})
+
+    def test_manage_rroles_handled(self):
+        cog = bot.ReactionRoles.__new__(bot.ReactionRoles)
+        cog.bot = types.SimpleNamespace(
+            metrics=types.SimpleNamespace(active=False))
+        cog.pending = {}
+        #A rescheduled call for an entry already handled does nothing
+        self.assertIsNone(asyncio.run(cog.manage_rroles(10, 4)))
+
 class TestVoiceChannelControlCog(unittest.TestCase):
 
     def open_file(self):
@@ -205,5 +1065,74 @@ class TestWelcomeMessageCog(unittest.TestCase):
             all([isinstance(data[i]['fields'][j], str)
                  for i in data for j in data[i]['fields']]))
 
+class TestBenchmarks(unittest.TestCase):
+
+    def test_harness(self):
+        scenarios = [
+            "message", "message_delete", "reaction_roles", "guild_points",
+            "voice_control"]
+        async def run():
+            harness = benchmarks.Harness(members=20, latency=0)
+            harness.utils.get_cog("ReactionRoles").delay = 0
+            results = {}
+            for scenario in scenarios:
+                results[scenario] = await harness.run(
+                    scenario, events=5, rate=1000)
+                #Every scenario runs its handlers without errors
+                self.assertEqual(harness.errors, {}, scenario)
+            harness.utils.log_listener.stop()
+            harness.utils.database.close()
+            return results
+        results = asyncio.run(run())
+        self.assertEqual(list(results), scenarios)
+        self.assertTrue(all([r["Errors"] == 0 for r in results.values()]))
+        self.assertTrue(results["voice_control"]["REST calls/event"] > 0)
+
+    def test_replay_capture(self):
+        user = {
+            "id": "1", "username": "Member", "discriminator": "0000",
+            "avatar": None}
+        bot_user = dict(user, id="2", username="Utils", bot=True)
+        guild = {
+            "id": "3", "name": "Guild", "member_count": 1,
+            "roles": [{
+                "id": "3", "name": "@everyone", "position": 0,
+                "permissions": "0", "color": 0, "hoist": False,
+                "managed": False, "mentionable": False}],
+            "channels": [{
+                "id": "4", "type": 0, "name": "general", "position": 0,
+                "permission_overwrites": []}],
+            "members": [{
+                "user": user, "roles": [], "deaf": False, "mute": False,
+                "joined_at": "2021-01-01T00:00:00+00:00"}]}
+        message = {
+            "id": "5", "channel_id": "4", "guild_id": "3", "author": user,
+            "member": {"roles": [], "deaf": False, "mute": False,
+                       "joined_at": "2021-01-01T00:00:00+00:00"},
+            "content": "gg", "tts": False, "pinned": False,
+            "timestamp": "2021-01-01T00:00:00+00:00",
+            "edited_timestamp": None, "mention_everyone": False,
+            "mentions": [], "mention_roles": [], "attachments": [],
+            "embeds": [], "type": 0}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.jsonl.gz')
+            recorder = bot.EventRecorder(path)
+            async def record():
+                for kind, data in [
+                        ("READY", {"user": bot_user}),
+                        ("GUILD_CREATE", guild),
+                        ("MESSAGE_CREATE", message)]:
+                    await recorder.record({"op": 0, "t": kind, "d": data})
+                #Messages other than dispatches are not recorded
+                await recorder.record({"op": 11, "d": None})
+            asyncio.run(record())
+            recorder.close()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                events = asyncio.run(
+                    benchmarks.replay_capture(path, speed=0, latency=0))
+        self.assertEqual(events, {"MESSAGE_CREATE": 1})
+        self.assertIn("(max speed, 0 ms REST latency)", output.getvalue())
+
 if __name__ == '__main__':
     unittest.main()